@@ -1,14 +1,194 @@
 from typing import List, Dict, Any, Optional, Tuple
 import re
-from google import genai
-import os
-from dotenv import load_dotenv
+import asyncio
+import orjson
+from google.genai import errors
 
-load_dotenv()
+from chat.cache import DiskCache, LRUCache
+from chat.gemini_client import get_client
+from chat.media import create_image_part, sniff_image_mime_type
 
-# Initialize Gemini client
-client = genai.Client(api_key=os.getenv('GEMINI_API_KEY'))
-# client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+# Maximum number of chunk extractions in flight at once (keeps us under Gemini QPM limits)
+MAX_CONCURRENT_EXTRACTIONS = 10
+
+# Number of document chunks packed into a single Gemini call
+CHUNKS_PER_CALL = 4
+
+# Retry settings for transient Gemini errors (rate limiting / server errors)
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 1.0
+RETRYABLE_STATUS_CODES = {429, 500, 503}
+
+# Bump whenever the extraction prompts change so stale cache entries are ignored
+PROMPT_VERSION = "2"
+
+# Characters that matter when scanning for a JSON object, outside and inside string literals
+_JSON_STRUCTURE_RE = re.compile(r'[{}"]')
+_JSON_STRING_SPECIAL_RE = re.compile(r'["\\]')
+
+# Paragraph boundaries used when chunking long documents
+_PARAGRAPH_BREAK_RE = re.compile(r'\n\s*\n')
+
+# Prompts are kept static, with the variable content appended at the end,
+# so identical prefixes can be reused by Gemini's implicit prompt caching.
+_TEXT_RESULT_FORMAT = """{
+    "entities": [
+        {
+            "name": "entity_name",
+            "type": "entity_type",
+            "properties": {
+                "property_name": {
+                    "value": "property_value",
+                    "metadata": "source: text confidence: 0.9"
+                }
+            }
+        }
+    ],
+    "relationships": [
+        {
+            "from_entity": "entity1_name",
+            "relationship_type": "relates_to",
+            "to_entity": "entity2_name",
+            "context": "relationship_context confidence: 0.85"
+        }
+    ],
+    "faq_entries": [
+        {
+            "question": "extracted_question",
+            "answer": "extracted_answer",
+            "category": "extracted_category",
+            "concepts": "space_separated_concepts"
+        }
+    ]
+}"""
+
+_TEXT_EXTRACTION_PROMPT = f"""Extract structured knowledge from the text at the end of this prompt. Identify entities, their properties, 
+and relationships between entities. Format the output as JSON.
+
+Output format:
+{_TEXT_RESULT_FORMAT}
+
+Only extract information that is explicitly stated or strongly implied in the text.
+Assign confidence scores based on how explicitly the information is stated.
+
+Text: """
+
+_BATCH_EXTRACTION_PROMPT = f"""Extract structured knowledge from each of the text chunks at the end of this prompt independently.
+Each chunk is delimited by <<<CHUNK i>>> and <<<END>>>. For every chunk, identify entities, 
+their properties, and relationships between entities. Format the output as JSON.
+
+Output format:
+{{"results": [<result for chunk 0>, <result for chunk 1>, ...]}}
+
+with one result per chunk, in chunk order, each in this format:
+{_TEXT_RESULT_FORMAT}
+
+Only extract information that is explicitly stated or strongly implied in the text.
+Assign confidence scores based on how explicitly the information is stated.
+
+"""
+
+_IMAGE_EXTRACTION_PROMPT = """Analyze this image and extract structured knowledge from it. Identify entities, their properties, 
+and relationships between entities. Format the output as JSON.
+
+Output format:
+{
+    "entities": [
+        {
+            "name": "entity_name",
+            "type": "entity_type",
+            "properties": {
+                "property_name": {
+                    "value": "property_value",
+                    "metadata": "source: image confidence: 0.8"
+                }
+            }
+        }
+    ],
+    "relationships": [
+        {
+            "from_entity": "entity1_name",
+            "relationship_type": "relates_to",
+            "to_entity": "entity2_name",
+            "context": "relationship_context confidence: 0.75"
+        }
+    ]
+}
+
+Only extract information that is clearly visible or strongly implied in the image.
+Assign confidence scores based on how clearly the information is presented.
+"""
+
+class _JsonObjectScanner:
+    """
+    Incrementally locates the first complete JSON object in text that arrives in pieces.
+    Tracks brace depth from the first '{', ignoring braces inside string literals.
+    """
+    
+    def __init__(self):
+        self._parts = []
+        self._length = 0
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+    
+    def feed(self, chunk: str) -> Optional[str]:
+        """Add the next piece of text. Returns the JSON object once its closing brace has been seen."""
+        offset = self._length
+        self._parts.append(chunk)
+        self._length += len(chunk)
+        
+        # Skip the character escaped by a backslash at the end of the previous piece
+        pos = 0
+        if self._escaped and chunk:
+            pos = 1
+            self._escaped = False
+        
+        while pos < len(chunk):
+            if self._in_string:
+                match = _JSON_STRING_SPECIAL_RE.search(chunk, pos)
+                if not match:
+                    break
+                if match.group() == '\\':
+                    if match.end() == len(chunk):
+                        self._escaped = True
+                    pos = match.end() + 1
+                else:
+                    self._in_string = False
+                    pos = match.end()
+                continue
+            
+            match = _JSON_STRUCTURE_RE.search(chunk, pos)
+            if not match:
+                break
+            char = match.group()
+            pos = match.end()
+            
+            if self._start is None:
+                # Ignore everything (including quotes) before the object starts
+                if char != '{':
+                    continue
+                self._start = offset + match.start()
+            
+            if char == '"':
+                self._in_string = True
+            elif char == '{':
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    return "".join(self._parts)[self._start:offset + pos]
+        
+        return None
+    
+    def fallback(self) -> str:
+        """Best-effort JSON for unbalanced (e.g. truncated) text: up to the last closing brace."""
+        if self._start is None:
+            return "{}"
+        text = "".join(self._parts)
+        end = text.rfind('}')
+        return text[self._start:end + 1] if end > self._start else "{}"
 
 class AutoExtractor:
     """
@@ -16,9 +196,18 @@ class AutoExtractor:
     Uses Gemini to extract structured knowledge from unstructured data.
     """
     
-    def __init__(self, model_name: str = 'gemini-2.0-flash'):
-        """Initialize the extractor with the specified model."""
+    def __init__(self, model_name: str = 'gemini-2.0-flash', cache_dir: Optional[str] = None):
+        """
+        Initialize the extractor with the specified model.
+        
+        Args:
+            model_name: The Gemini model to use
+            cache_dir: Optional directory for caching extraction results by content hash
+        """
         self.model_name = model_name
+        self.cache = DiskCache(cache_dir) if cache_dir else None
+        # Recent image extraction results, keyed by a hash of the image (users often resend the same image)
+        self._image_cache = LRUCache(maxsize=256)
     
     async def extract_from_text(self, text: str) -> Dict[str, Any]:
         """
@@ -30,141 +219,113 @@ class AutoExtractor:
         Returns:
             Dict with extracted entities and relationships
         """
-        prompt = f"""
-        Extract structured knowledge from the following text. Identify entities, their properties, 
-        and relationships between entities. Format the output as JSON.
-        
-        Text: {text}
-        
-        Output format:
-        {{
-            "entities": [
-                {{
-                    "name": "entity_name",
-                    "type": "entity_type",
-                    "properties": {{
-                        "property_name": {{
-                            "value": "property_value",
-                            "metadata": "source: text confidence: 0.9"
-                        }}
-                    }}
-                }}
-            ],
-            "relationships": [
-                {{
-                    "from_entity": "entity1_name",
-                    "relationship_type": "relates_to",
-                    "to_entity": "entity2_name",
-                    "context": "relationship_context confidence: 0.85"
-                }}
-            ],
-            "faq_entries": [
-                {{
-                    "question": "extracted_question",
-                    "answer": "extracted_answer",
-                    "category": "extracted_category",
-                    "concepts": "space_separated_concepts"
-                }}
-            ]
-        }}
-        
-        Only extract information that is explicitly stated or strongly implied in the text.
-        Assign confidence scores based on how explicitly the information is stated.
-        """
+        # Return the cached result if this exact text was extracted before
+        cached = self._get_cached(text)
+        if cached is not None:
+            return cached
         
-        response = client.models.generate_content(
-            model=self.model_name,
-            contents=prompt
-        )
+        prompt = _TEXT_EXTRACTION_PROMPT + text
         
-        # Extract JSON from response
-        json_str = self._extract_json(response.text)
+        # Stream the response and extract the JSON from it
+        json_str = await self._generate_json(prompt)
         
-        # Parse and validate the extracted data
-        return self._parse_and_validate(json_str)
+        # Parse and validate the extracted data, caching only well-formed results
+        try:
+            result = self._validate(orjson.loads(json_str))
+        except orjson.JSONDecodeError:
+            return {'entities': [], 'relationships': []}
+        
+        self._set_cached(text, result)
+        return result
+    
+    async def extract_from_text_batch(self, texts: List[str]) -> List[Dict[str, Any]]:
+        """
+        Extract entities and relationships from several texts with a single model call.
+        
+        Args:
+            texts: The texts to extract from
+            
+        Returns:
+            List of extraction results, one per input text (in the same order)
+        """
+        # Only send texts that are not already cached
+        results = [self._get_cached(text) for text in texts]
+        pending = [i for i, result in enumerate(results) if result is None]
+        
+        if len(pending) <= 1:
+            for i in pending:
+                results[i] = await self.extract_from_text(texts[i])
+            return results
+        
+        prompt = "".join([
+            _BATCH_EXTRACTION_PROMPT,
+            f"There are {len(pending)} chunks.\n\n",
+            "\n\n".join(f"<<<CHUNK {n}>>>\n{texts[i]}\n<<<END>>>" for n, i in enumerate(pending))
+        ])
+        
+        # Split the batched response back into per-chunk results
+        batch_results = self._parse_batch(await self._generate_json(prompt), len(pending))
+        
+        for n, i in enumerate(pending):
+            if batch_results is None:
+                # Fall back to one call per chunk if the batched output is unusable
+                results[i] = await self.extract_from_text(texts[i])
+            else:
+                results[i] = batch_results[n]
+                self._set_cached(texts[i], results[i])
+        
+        return results
     
     async def extract_from_image(self, image_data: Any, mime_type: str = None) -> Dict[str, Any]:
         """
         Extract entities and relationships from an image.
         
         Args:
-            image_data: The image data (bytes, path, or file-like object)
+            image_data: The image data (bytes, memoryview, or file-like object)
             mime_type: The MIME type of the image
             
         Returns:
             Dict with extracted entities and relationships
         """
-        # Create image part
-        import base64
-        
         # Create image part directly instead of importing GeminiLLM
-        if isinstance(image_data, bytes):
+        if isinstance(image_data, (bytes, bytearray, memoryview)):
             image_bytes = image_data
         else:
             # If it's a file-like object, read it
             image_bytes = image_data.read()
         
-        # Default to JPEG if mime_type not specified
-        mime_type = mime_type or "image/jpeg"
+        # Detect the image format if mime_type is missing or not an image type
+        if not mime_type or not mime_type.startswith('image/'):
+            mime_type = sniff_image_mime_type(image_bytes)
+        
+        # Return the cached result if this image was extracted before
+        cache_key = DiskCache.make_key(self.model_name, PROMPT_VERSION, mime_type, image_bytes)
+        cached = self._image_cache.get(cache_key)
+        if cached is not None:
+            return cached
         
         # Create image part
-        image_part = {
-            "inline_data": {
-                "mime_type": mime_type,
-                "data": base64.b64encode(image_bytes).decode('utf-8')
+        image_part = create_image_part(image_bytes, mime_type)
+        
+        # Stream the response and extract the JSON from it
+        json_str = await self._generate_json([
+            {
+                "role": "user",
+                "parts": [
+                    {"text": _IMAGE_EXTRACTION_PROMPT},
+                    image_part
+                ]
             }
-        }
-        
-        prompt = """
-        Analyze this image and extract structured knowledge from it. Identify entities, their properties, 
-        and relationships between entities. Format the output as JSON.
-        
-        Output format:
-        {
-            "entities": [
-                {
-                    "name": "entity_name",
-                    "type": "entity_type",
-                    "properties": {
-                        "property_name": {
-                            "value": "property_value",
-                            "metadata": "source: image confidence: 0.8"
-                        }
-                    }
-                }
-            ],
-            "relationships": [
-                {
-                    "from_entity": "entity1_name",
-                    "relationship_type": "relates_to",
-                    "to_entity": "entity2_name",
-                    "context": "relationship_context confidence: 0.75"
-                }
-            ]
-        }
-        
-        Only extract information that is clearly visible or strongly implied in the image.
-        Assign confidence scores based on how clearly the information is presented.
-        """
+        ])
         
-        response = client.models.generate_content(
-            model=self.model_name,
-            contents=[
-                {
-                    "role": "user",
-                    "parts": [
-                        {"text": prompt},
-                        image_part
-                    ]
-                }
-            ]
-        )
-        
-        # Extract JSON from response
-        json_str = self._extract_json(response.text)
+        # Parse and validate the extracted data, caching only well-formed results
+        try:
+            result = self._validate(orjson.loads(json_str))
+        except orjson.JSONDecodeError:
+            return {'entities': [], 'relationships': []}
         
-        # Parse and validate the extracted data
-        return self._parse_and_validate(json_str)
+        self._image_cache.set(cache_key, result)
+        return result
     
     async def extract_from_document(self, document_text: str) -> Dict[str, Any]:
         """
@@ -180,130 +341,166 @@ class AutoExtractor:
         # For longer documents, we need to chunk the text
         chunks = self._chunk_text(document_text, max_length=8000)
         
-        all_entities = []
-        all_relationships = []
-        all_faq_entries = []
-        
-        # Process each chunk
-        for chunk in chunks:
-            chunk_result = await self.extract_from_text(chunk)
-            
-            if 'entities' in chunk_result:
-                all_entities.extend(chunk_result['entities'])
-            
-            if 'relationships' in chunk_result:
-                all_relationships.extend(chunk_result['relationships'])
-            
-            if 'faq_entries' in chunk_result:
-                all_faq_entries.extend(chunk_result['faq_entries'])
-        
-        # Deduplicate entities
-        unique_entities = self._deduplicate_entities(all_entities)
+        # Deduplicated results, keyed by entity name, relationship triple and FAQ question
+        unique_entities = {}
+        unique_relationships = {}
+        unique_faq_entries = {}
         
-        # Deduplicate relationships
-        unique_relationships = self._deduplicate_relationships(all_relationships)
+        # Pack chunks into batches and process the batches concurrently, bounded by a semaphore
+        batches = [chunks[i:i + CHUNKS_PER_CALL] for i in range(0, len(chunks), CHUNKS_PER_CALL)]
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_EXTRACTIONS)
         
-        # Deduplicate FAQ entries
-        unique_faq_entries = self._deduplicate_faq_entries(all_faq_entries)
+        # Merge each batch into the deduplicated results as soon as it completes
+        for batch_result in asyncio.as_completed([
+            self._extract_batch(batch, semaphore) for batch in batches
+        ]):
+            for chunk_result in await batch_result:
+                self._merge_entities(unique_entities, chunk_result.get('entities', []))
+                self._merge_relationships(unique_relationships, chunk_result.get('relationships', []))
+                self._merge_faq_entries(unique_faq_entries, chunk_result.get('faq_entries', []))
         
         return {
-            'entities': unique_entities,
-            'relationships': unique_relationships,
-            'faq_entries': unique_faq_entries
+            'entities': list(unique_entities.values()),
+            'relationships': list(unique_relationships.values()),
+            'faq_entries': list(unique_faq_entries.values())
         }
     
-    def _extract_json(self, text: str) -> str:
-        """Extract JSON from text."""
-        # Look for JSON pattern
-        json_match = re.search(r'({[\s\S]*})', text)
-        if json_match:
-            return json_match.group(1)
-        return "{}"
+    async def _extract_batch(self, chunks: List[str], semaphore: asyncio.Semaphore) -> List[Dict[str, Any]]:
+        """
+        Extract knowledge from a batch of document chunks.
+        Retries transient Gemini errors with exponential backoff.
+        """
+        async with semaphore:
+            for attempt in range(MAX_RETRIES + 1):
+                try:
+                    return await self.extract_from_text_batch(chunks)
+                except errors.APIError as e:
+                    if e.code not in RETRYABLE_STATUS_CODES or attempt == MAX_RETRIES:
+                        raise
+                    await asyncio.sleep(RETRY_BASE_DELAY * (2 ** attempt))
     
-    def _parse_and_validate(self, json_str: str) -> Dict[str, Any]:
-        """Parse and validate the extracted JSON."""
-        import json
+    def _cache_key(self, text: str) -> str:
+        """Build the cache key for extracting from a piece of text."""
+        return DiskCache.make_key(self.model_name, PROMPT_VERSION, text)
+    
+    def _get_cached(self, text: str) -> Optional[Dict[str, Any]]:
+        """Return the cached extraction result for a text, if caching is enabled."""
+        if self.cache is None:
+            return None
+        
+        cached = self.cache.get(self._cache_key(text))
+        if not isinstance(cached, dict):
+            return None
+        
+        # Revalidate the cached entry before handing it out
+        return self._validate(cached)
+    
+    def _set_cached(self, text: str, result: Dict[str, Any]):
+        """Store an extraction result for a text, if caching is enabled."""
+        if self.cache is not None:
+            self.cache.set(self._cache_key(text), result)
+    
+    async def _generate_json(self, contents: Any) -> str:
+        """
+        Stream a Gemini response and return the first complete JSON object in it.
+        Stops reading as soon as the object is closed instead of waiting for the whole response.
+        """
+        scanner = _JsonObjectScanner()
+        stream = await get_client().aio.models.generate_content_stream(
+            model=self.model_name,
+            contents=contents
+        )
         try:
-            data = json.loads(json_str)
-            # Ensure required fields are present
-            if 'entities' not in data:
-                data['entities'] = []
-            if 'relationships' not in data:
-                data['relationships'] = []
-            return data
-        except json.JSONDecodeError:
-            # Return empty structure if JSON is invalid
-            return {'entities': [], 'relationships': []}
+            async for chunk in stream:
+                if chunk.text:
+                    json_str = scanner.feed(chunk.text)
+                    if json_str is not None:
+                        return json_str
+        finally:
+            await stream.aclose()
+        
+        return scanner.fallback()
+    
+    def _validate(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Ensure required fields are present in an extraction result."""
+        if 'entities' not in data:
+            data['entities'] = []
+        if 'relationships' not in data:
+            data['relationships'] = []
+        return data
+    
+    def _parse_batch(self, json_str: str, expected: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Parse a batched extraction response into per-chunk results.
+        Returns None if the response is not valid JSON or has the wrong number of results.
+        """
+        try:
+            results = orjson.loads(json_str).get('results')
+        except (orjson.JSONDecodeError, AttributeError):
+            return None
+        
+        if not isinstance(results, list) or len(results) != expected:
+            return None
+        if not all(isinstance(result, dict) for result in results):
+            return None
+        
+        return [self._validate(result) for result in results]
     
     def _chunk_text(self, text: str, max_length: int = 8000) -> List[str]:
         """Split text into chunks of maximum length."""
-        # Simple chunking by paragraphs
-        paragraphs = text.split('\n\n')
+        # Simple chunking by paragraphs (blank lines, possibly containing whitespace)
+        paragraphs = _PARAGRAPH_BREAK_RE.split(text)
         chunks = []
-        current_chunk = ""
+        
+        # Accumulate paragraphs and join them only when a chunk is emitted
+        # (a chunk made up only of empty paragraphs has zero length and counts as empty, as before)
+        current_chunk = []
+        current_length = 0
         
         for paragraph in paragraphs:
-            if len(current_chunk) + len(paragraph) + 2 <= max_length:
-                if current_chunk:
-                    current_chunk += "\n\n" + paragraph
+            added_length = len(paragraph) + (2 if current_length else 0)
+            if current_length + added_length <= max_length:
+                if current_length:
+                    current_chunk.append(paragraph)
                 else:
-                    current_chunk = paragraph
+                    current_chunk = [paragraph]
+                current_length += added_length
             else:
-                if current_chunk:
-                    chunks.append(current_chunk)
-                current_chunk = paragraph
+                if current_length:
+                    chunks.append("\n\n".join(current_chunk))
+                current_chunk = [paragraph]
+                current_length = len(paragraph)
         
-        if current_chunk:
-            chunks.append(current_chunk)
+        if current_length:
+            chunks.append("\n\n".join(current_chunk))
         
         return chunks
     
-    def _deduplicate_entities(self, entities: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """Deduplicate entities by name."""
-        unique_entities = {}
-        
+    def _merge_entities(self, unique_entities: Dict[str, Dict[str, Any]], entities: List[Dict[str, Any]]):
+        """Merge entities into a dict of unique entities keyed by name."""
         for entity in entities:
-            name = entity.get('name', '')
-            if name:
-                if name not in unique_entities:
-                    unique_entities[name] = entity
-                else:
-                    # Merge properties
-                    existing_props = unique_entities[name].get('properties', {})
-                    new_props = entity.get('properties', {})
-                    
-                    for prop_name, prop_value in new_props.items():
-                        if prop_name not in existing_props:
-                            existing_props[prop_name] = prop_value
-                    
-                    unique_entities[name]['properties'] = existing_props
-        
-        return list(unique_entities.values())
+            name = entity.get('name')
+            if not name:
+                continue
+            existing = unique_entities.setdefault(name, entity)
+            if existing is not entity:
+                # Merge properties in place, keeping the first value seen for each property
+                new_props = entity.get('properties')
+                if new_props:
+                    existing_props = existing.setdefault('properties', {})
+                    for key, value in new_props.items():
+                        existing_props.setdefault(key, value)
     
-    def _deduplicate_relationships(self, relationships: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """Deduplicate relationships."""
-        unique_relationships = {}
-        
+    def _merge_relationships(self, unique_relationships: Dict[Tuple[str, str, str], Dict[str, Any]],
+                             relationships: List[Dict[str, Any]]):
+        """Merge relationships into a dict of unique relationships keyed by (from, type, to)."""
         for rel in relationships:
-            from_entity = rel.get('from_entity', '')
-            rel_type = rel.get('relationship_type', '')
-            to_entity = rel.get('to_entity', '')
-            
-            key = f"{from_entity}|{rel_type}|{to_entity}"
-            
-            if key and key not in unique_relationships:
-                unique_relationships[key] = rel
-        
-        return list(unique_relationships.values())
+            key = (rel.get('from_entity', ''), rel.get('relationship_type', ''), rel.get('to_entity', ''))
+            unique_relationships.setdefault(key, rel)
     
-    def _deduplicate_faq_entries(self, faq_entries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """Deduplicate FAQ entries by question."""
-        unique_faqs = {}
-        
+    def _merge_faq_entries(self, unique_faqs: Dict[str, Dict[str, Any]], faq_entries: List[Dict[str, Any]]):
+        """Merge FAQ entries into a dict of unique FAQ entries keyed by question."""
         for faq in faq_entries:
-            question = faq.get('question', '')
-            
-            if question and question not in unique_faqs:
-                unique_faqs[question] = faq
-        
-        return list(unique_faqs.values()) 
\ No newline at end of file
+            question = faq.get('question')
+            if question:
+                unique_faqs.setdefault(question, faq)
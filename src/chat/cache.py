@@ -0,0 +1,140 @@
+from typing import Any, Hashable, Optional, Union
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Sentence punctuation stripped from the ends of words when normalizing questions for the
+# question cache (symbols inside or ending words, as in "C++" or "C#", are kept)
+_SENTENCE_PUNCTUATION = '.,;:!?"\'()[]{}'
+
+
+class LRUCache:
+    """
+    Bounded in-memory cache that evicts the least recently used entry.
+    Safe to share between the event loop and worker threads.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        """Initialize an empty cache holding at most maxsize entries."""
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value for a key, or None on a miss."""
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: Hashable, value: Any):
+        """Store a value, evicting the oldest entry if the cache is full."""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+class QuestionCache:
+    """
+    Bounded in-memory cache of answers keyed by normalized question text.
+    Questions only match if they are identical after case folding and removing sentence
+    punctuation (word order is kept, as it changes meaning); entries only match
+    within the same scope (e.g. a hash of the context the answer was generated from).
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 3600.0):
+        """Initialize an empty cache holding at most maxsize entries for ttl seconds."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Return the text case-folded with sentence punctuation removed and whitespace collapsed."""
+        words = (word.strip(_SENTENCE_PUNCTUATION) for word in text.casefold().split())
+        return " ".join(word for word in words if word)
+
+    def get(self, text: str, scope: str = "") -> Optional[Any]:
+        """Return the value stored for the text in scope, or None on a miss."""
+        key = (scope, self.normalize(text))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, created = entry
+            if time.monotonic() - created > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, text: str, value: Any, scope: str = ""):
+        """Store a value for a text, evicting the least recently used entry if the cache is full."""
+        normalized = self.normalize(text)
+        if not normalized:
+            return
+        
+        key = (scope, normalized)
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+class DiskCache:
+    """
+    Content-addressable cache for LLM results.
+    Each entry is stored as a JSON file named after the hash of its inputs.
+    """
+
+    def __init__(self, cache_dir: Union[str, Path]):
+        """Initialize the cache, creating the cache directory if needed."""
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts: Union[str, bytes]) -> str:
+        """Build a cache key by hashing the given parts (model, prompt version, content, ...)."""
+        digest = hashlib.blake2b()
+        for part in parts:
+            digest.update(part.encode('utf-8') if isinstance(part, str) else part)
+            digest.update(b'|')
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for a key, or None on a miss."""
+        try:
+            with open(self.cache_dir / f"{key}.json", 'r') as f:
+                return json.load(f)['value']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def set(self, key: str, value: Any):
+        """Store a JSON-serializable value under a key."""
+        # Write to a temporary file first so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'value': value
+            }, f)
+        os.replace(tmp_path, self.cache_dir / f"{key}.json")
@@ -0,0 +1,22 @@
+from typing import Optional
+import os
+import threading
+from google import genai
+from dotenv import load_dotenv
+
+load_dotenv()
+
+_client: Optional[genai.Client] = None
+_client_lock = threading.Lock()
+
+def get_client() -> genai.Client:
+    """
+    Return the Gemini client shared by the whole process.
+    The client is created on first use so importing the chat modules stays cheap.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = genai.Client(api_key=os.getenv('GEMINI_API_KEY'))
+    return _client
@@ -1,27 +1,122 @@
 from typing import List, Dict, Any, Optional, Union, BinaryIO
-import os
-import base64
 from pathlib import Path
+import asyncio
+import logging
 import mimetypes
-from google import genai
-from dotenv import load_dotenv
 import re
 
-load_dotenv()
+from chat.cache import DiskCache
+from chat.gemini_client import get_client
+from chat.media import create_image_part, sniff_image_mime_type
 
-# Initialize Gemini client
-client = genai.Client(api_key=os.getenv('GEMINI_API_KEY'))
+logger = logging.getLogger(__name__)
+
+# Bump whenever the response prompt changes so stale cache entries are ignored
+PROMPT_VERSION = "2"
+
+# Technical terms highlighted with <code> tags in plain-text responses
+TECH_TERMS = ["MeTTa", "GraphRAG", "Knowledge Graph", "Gemini", "Neo4j", "Entity Extraction",
+              "Multimodal", "LLM", "RAG", "API"]
+
+# Phrases linked to their reference pages in plain-text responses
+REFERENCE_LINKS = {
+    "MeTTa documentation": "https://github.com/trueagi-io/metta",
+    "Gemini API": "https://ai.google.dev/gemini-api",
+    "Neo4j": "https://neo4j.com/",
+}
+
+# Precompiled patterns for response post-processing
+_CODE_FENCE_RE = re.compile(r'^\s*```(?:html)?\s*(.*?)\s*```\s*$', re.DOTALL)
+_HTML_TAG_RE = re.compile(r'</?[a-zA-Z]')
+_IMAGE_RE = re.compile(r'\[IMAGE:\s*(.*?)\]')
+
+# Static instructions sent ahead of the per-request history, context and question,
+# so every prompt shares the same prefix for Gemini's implicit prompt caching
+_RESPONSE_INSTRUCTIONS = """You are a domain-specific FAQ chatbot with knowledge graph integration.
+
+Answer the user question given at the end of this prompt.
+Please provide a comprehensive answer based on the context information provided. 
+If the context doesn't contain relevant information, provide a general response based on your knowledge.
+
+Format your response with HTML for rich presentation:
+1. Use <h3> tags for section headings
+2. Use <ul> and <li> for lists
+3. Use <a href="URL">text</a> for links to relevant resources
+4. Use <code> tags for code or technical terms
+5. Use <b> and <i> for emphasis
+6. Use <div class="definition"> for term definitions
+7. Use <div class="example"> for examples
+8. For diagrams or visualizations, describe them with [IMAGE: description of what to visualize] and they will be rendered as images
+9. For interactive elements, use:
+   - <div class="interactive-element">
+       <div class="collapsible-header">Title <button class="toggle-button">Show</button></div>
+       <div class="collapsible-content">Content goes here...</div>
+     </div>
+
+IMPORTANT: Return the HTML directly, NOT wrapped in markdown code blocks. Do not use ```html or ``` tags.
+
+Your response should be informative, accurate, and helpful.
+
+"""
+
+def _highlight(phrase: str) -> str:
+    """Build the HTML for a technical term and/or reference phrase."""
+    html = phrase
+    if phrase in REFERENCE_LINKS:
+        html = f'<a href="{REFERENCE_LINKS[phrase]}" target="_blank">{html}</a>'
+    if phrase in TECH_TERMS:
+        html = f'<code>{html}</code>'
+    return html
+
+# Replacement HTML for every highlighted phrase, applied in a single pass.
+# Longer phrases are listed first so "Gemini API" wins over "Gemini".
+_HIGHLIGHTS = {phrase: _highlight(phrase) for phrase in [*TECH_TERMS, *REFERENCE_LINKS]}
+_HIGHLIGHT_PATTERN = r'\b(?P<phrase>' + '|'.join(map(re.escape, sorted(_HIGHLIGHTS, key=len, reverse=True))) + r')\b'
+_HIGHLIGHT_RE = re.compile(_HIGHLIGHT_PATTERN)
+
+# Everything the plain-text formatter rewrites, matched in a single scan:
+# definitions (a term followed by colon and explanation), highlighted phrases and paragraph breaks
+_PLAIN_TEXT_RE = re.compile(
+    r'(?P<term>[A-Z][a-zA-Z\s]+):\s(?P<body>[^\.]+\.)'
+    r'|' + _HIGHLIGHT_PATTERN +
+    r'|(?P<paragraph>\n\n)'
+)
+
+def _format_inline(text: str) -> str:
+    """Highlight phrases and convert paragraph breaks within a fragment of text."""
+    return _HIGHLIGHT_RE.sub(lambda m: _HIGHLIGHTS[m.group('phrase')], text).replace("\n\n", "</p><p>")
+
+def _format_plain_text_match(match: re.Match) -> str:
+    """Render one definition, highlighted phrase or paragraph break."""
+    if match.group('term') is not None:
+        return (f'<div class="definition"><b>{_format_inline(match.group("term"))}:</b> '
+                f'{_format_inline(match.group("body"))}</div>')
+    if match.group('phrase') is not None:
+        return _HIGHLIGHTS[match.group('phrase')]
+    return "</p><p>"
+
+def error_response(error: Exception) -> str:
+    """Build the apology returned as the response when generating it failed."""
+    return f"I'm sorry, I encountered an error processing your request: {str(error)}"
 
 class GeminiLLM:
-    def __init__(self, model_name: str = 'gemini-2.0-flash'):
-        """Initialize Gemini LLM with specified model."""
+    def __init__(self, model_name: str = 'gemini-2.0-flash', cache_dir: Optional[str] = None):
+        """
+        Initialize Gemini LLM with specified model.
+        
+        Args:
+            model_name: The Gemini model to use
+            cache_dir: Optional directory for caching responses by prompt hash
+        """
         self.model_name = model_name
+        self.cache = DiskCache(cache_dir) if cache_dir else None
         
     async def generate_response(self, 
                               question: str, 
                               context: List[Dict[str, Any]], 
                               history: Optional[List[Dict[str, str]]] = None,
-                              media_files: Optional[List[Dict[str, Any]]] = None) -> str:
+                              media_files: Optional[List[Dict[str, Any]]] = None,
+                              raise_errors: bool = False) -> str:
         """
         Generate a response using Gemini with context from the knowledge graph.
         
@@ -30,6 +125,7 @@ class GeminiLLM:
             context: Relevant context from knowledge graph
             history: Chat history for context
             media_files: List of media files (images, videos, etc.)
+            raise_errors: Raise errors instead of returning an apology message as the response
             
         Returns:
             str: Generated response
@@ -41,37 +137,26 @@ class GeminiLLM:
         history_str = self._format_history(history) if history else ""
         
         # Create the prompt
-        prompt = f"""You are a domain-specific FAQ chatbot with knowledge graph integration.
+        prompt = "".join([
+            _RESPONSE_INSTRUCTIONS,
+            history_str,
+            "\n\nCONTEXT INFORMATION:\n",
+            context_str,
+            "\n\nUSER QUESTION: ",
+            question,
+            "\n"
+        ])
         
-{history_str}
-
-CONTEXT INFORMATION:
-{context_str}
-
-USER QUESTION: {question}
-
-Please provide a comprehensive answer based on the context information provided. 
-If the context doesn't contain relevant information, provide a general response based on your knowledge.
-
-Format your response with HTML for rich presentation:
-1. Use <h3> tags for section headings
-2. Use <ul> and <li> for lists
-3. Use <a href="URL">text</a> for links to relevant resources
-4. Use <code> tags for code or technical terms
-5. Use <b> and <i> for emphasis
-6. Use <div class="definition"> for term definitions
-7. Use <div class="example"> for examples
-8. For diagrams or visualizations, describe them with [IMAGE: description of what to visualize] and they will be rendered as images
-9. For interactive elements, use:
-   - <div class="interactive-element">
-       <div class="collapsible-header">Title <button class="toggle-button">Show</button></div>
-       <div class="collapsible-content">Content goes here...</div>
-     </div>
-
-IMPORTANT: Return the HTML directly, NOT wrapped in markdown code blocks. Do not use ```html or ``` tags.
-
-Your response should be informative, accurate, and helpful.
-"""
+        # Return the cached response if this exact prompt (and media) was answered before
+        cache_key = None
+        if self.cache is not None:
+            cache_key = DiskCache.make_key(
+                self.model_name, PROMPT_VERSION, prompt,
+                *[media_file['data'] for media_file in media_files or []]
+            )
+            cached = self.cache.get(cache_key)
+            if isinstance(cached, str):
+                return cached
         
         try:
             # Prepare contents for the API call
@@ -98,18 +183,23 @@ Your response should be informative, accurate, and helpful.
             contents.append(content)
             
             # Generate response using the client
-            response = client.models.generate_content(
+            response = await get_client().aio.models.generate_content(
                 model=self.model_name,
                 contents=contents
             )
             
-            # Process the response to ensure it has proper HTML formatting
-            formatted_response = self._ensure_html_formatting(response.text)
+            # Process the response to ensure it has proper HTML formatting (off the event loop)
+            formatted_response = await asyncio.to_thread(self._ensure_html_formatting, response.text)
+            
+            if cache_key is not None:
+                self.cache.set(cache_key, formatted_response)
             
             return formatted_response
         except Exception as e:
-            print(f"Error generating response: {str(e)}")
-            return f"I'm sorry, I encountered an error processing your request: {str(e)}"
+            logger.error("Error generating response: %s", e)
+            if raise_errors:
+                raise
+            return error_response(e)
     
     def _ensure_html_formatting(self, text: str) -> str:
         """
@@ -117,140 +207,127 @@ Your response should be informative, accurate, and helpful.
         If the response doesn't contain HTML tags, add basic formatting.
         """
         # Remove markdown code block markers if present
-        if text.startswith("```html") and text.endswith("```"):
-            text = text[7:-3].strip()
-        elif text.startswith("```") and text.endswith("```"):
-            text = text[3:-3].strip()
+        fence_match = _CODE_FENCE_RE.match(text)
+        if fence_match:
+            text = fence_match.group(1)
         
         # Process image descriptions
-        image_pattern = r'\[IMAGE:\s*(.*?)\]'
+        text = _IMAGE_RE.sub(self._replace_with_image, text)
         
-        def replace_with_image(match):
-            description = match.group(1).strip()
-            # For demo purposes, use placeholder images based on the description
-            if "graph" in description.lower() or "network" in description.lower():
-                return f'<img src="https://via.placeholder.com/600x400/4285F4/FFFFFF?text=Knowledge+Graph+Visualization" alt="{description}" />'
-            elif "hierarchy" in description.lower() or "tree" in description.lower():
-                return f'<img src="https://via.placeholder.com/600x400/34A853/FFFFFF?text=Hierarchy+Diagram" alt="{description}" />'
-            elif "flow" in description.lower() or "process" in description.lower():
-                return f'<img src="https://via.placeholder.com/600x400/FBBC05/FFFFFF?text=Process+Flow" alt="{description}" />'
-            elif "comparison" in description.lower():
-                return f'<img src="https://via.placeholder.com/600x400/EA4335/FFFFFF?text=Comparison+Chart" alt="{description}" />'
-            else:
-                return f'<img src="https://via.placeholder.com/600x400/9C27B0/FFFFFF?text=Visualization" alt="{description}" />'
-        
-        text = re.sub(image_pattern, replace_with_image, text)
-        
-        # Check if the response already has HTML
-        if "<" in text and ">" in text:
+        # Check if the response already has HTML tags
+        if _HTML_TAG_RE.search(text):
             # Already has some HTML, return as is
             return text
         
-        # Add basic HTML formatting
-        formatted_text = text
-        
-        # Format definitions (terms followed by colon and explanation)
-        definition_pattern = r'([A-Z][a-zA-Z\s]+):\s([^\.]+\.)'
-        formatted_text = re.sub(definition_pattern, r'<div class="definition"><b>\1:</b> \2</div>', formatted_text)
-        
-        # Format technical terms
-        tech_terms = ["MeTTa", "GraphRAG", "Knowledge Graph", "Gemini", "Neo4j", "Entity Extraction", 
-                      "Multimodal", "LLM", "RAG", "API"]
-        for term in tech_terms:
-            formatted_text = re.sub(r'\b' + re.escape(term) + r'\b', r'<code>\g<0></code>', formatted_text)
-        
-        # Add paragraph breaks
-        formatted_text = "<p>" + formatted_text.replace("\n\n", "</p><p>") + "</p>"
-        
-        # Add links for common references
-        formatted_text = formatted_text.replace("MeTTa documentation", '<a href="https://github.com/trueagi-io/metta" target="_blank">MeTTa documentation</a>')
-        formatted_text = formatted_text.replace("Gemini API", '<a href="https://ai.google.dev/gemini-api" target="_blank">Gemini API</a>')
-        formatted_text = formatted_text.replace("Neo4j", '<a href="https://neo4j.com/" target="_blank">Neo4j</a>')
-        
-        return formatted_text
+        # Add basic HTML formatting: definitions, technical terms, links and paragraph breaks
+        return "<p>" + _PLAIN_TEXT_RE.sub(_format_plain_text_match, text) + "</p>"
+    
+    @staticmethod
+    def _replace_with_image(match: re.Match) -> str:
+        """Replace an [IMAGE: description] marker with a placeholder image."""
+        description = match.group(1).strip()
+        # For demo purposes, use placeholder images based on the description
+        if "graph" in description.lower() or "network" in description.lower():
+            return f'<img src="https://via.placeholder.com/600x400/4285F4/FFFFFF?text=Knowledge+Graph+Visualization" alt="{description}" />'
+        elif "hierarchy" in description.lower() or "tree" in description.lower():
+            return f'<img src="https://via.placeholder.com/600x400/34A853/FFFFFF?text=Hierarchy+Diagram" alt="{description}" />'
+        elif "flow" in description.lower() or "process" in description.lower():
+            return f'<img src="https://via.placeholder.com/600x400/FBBC05/FFFFFF?text=Process+Flow" alt="{description}" />'
+        elif "comparison" in description.lower():
+            return f'<img src="https://via.placeholder.com/600x400/EA4335/FFFFFF?text=Comparison+Chart" alt="{description}" />'
+        else:
+            return f'<img src="https://via.placeholder.com/600x400/9C27B0/FFFFFF?text=Visualization" alt="{description}" />'
     
-    def _create_image_part(self, image_data: Union[bytes, BinaryIO], mime_type: str = None) -> Dict:
+    def _create_image_part(self, image_data: Union[bytes, memoryview, BinaryIO], mime_type: str = None) -> Dict:
         """Create an image part for the Gemini API."""
         try:
-            # If image_data is already bytes, use it directly
-            if isinstance(image_data, bytes):
+            # If image_data is already a bytes-like buffer, use it directly
+            if isinstance(image_data, (bytes, bytearray, memoryview)):
                 image_bytes = image_data
             else:
                 # If it's a file-like object, read it
                 image_bytes = image_data.read()
             
-            # Default to JPEG if mime_type not specified
-            mime_type = mime_type or "image/jpeg"
+            # Detect the image format if mime_type is missing or not an image type
+            if not mime_type or not mime_type.startswith('image/'):
+                mime_type = sniff_image_mime_type(image_bytes)
 
-            print(f"Image MIME: {mime_type}")
-            print(f"Image data length: {len(image_bytes)} bytes")
-            print(f"Base64 sample: {base64.b64encode(image_bytes).decode('utf-8')[:20]}...")
-            
             # Create image part using the Gemini API
-            return {
-                "inline_data": {
-                    "mime_type": mime_type,
-                    "data": base64.b64encode(image_bytes).decode('utf-8')
-                }
-            }
+            image_part = create_image_part(image_bytes, mime_type)
+            
+            logger.debug("Image MIME: %s", mime_type)
+            logger.debug("Image data length: %d bytes", len(image_bytes))
+            logger.debug("Base64 sample: %s...", image_part['inline_data']['data'][:20])
+            
+            return image_part
         except Exception as e:
-            print(f"Error creating image part: {str(e)}")
+            logger.error("Error creating image part: %s", e)
             raise
     
     def _format_context(self, context: List[Dict[str, Any]]) -> str:
         """Format knowledge graph context into a structured string."""
-        sections = []
+        # Each section collects its pieces in one buffer and is joined once at the end
+        faq_parts = []
+        entity_parts = []
+        hierarchy_parts = []
+        context_rel_parts = []
         
-        # Process FAQs
-        faqs = [item['faq'] for item in context if 'faq' in item]
-        if faqs:
-            faq_section = "RELEVANT FAQs:\n" + "\n\n".join([
-                f"Q: {faq['question']}\n"
-                f"A: {faq['answer']}\n"
-                f"Category: {faq.get('category', 'General')}\n"
-                f"Match Type: {faq.get('match_type', 'direct')}"
-                for faq in faqs
-            ])
-            sections.append(faq_section)
-        
-        # Process Entities
-        entities = [item['entity'] for item in context if 'entity' in item]
-        if entities:
-            entity_section = "RELEVANT ENTITIES:\n" + "\n\n".join([
-                f"Entity: {entity['name']} (Type: {entity['type']})\n"
-                f"Properties:\n" + "\n".join([
-                    f"- {key}: {value['value']} "
-                    f"(Metadata: {value['metadata']})"
-                    for key, value in entity['properties'].items()
-                ]) + "\n"
-                f"Relationships:\n" + "\n".join([
-                    f"- {rel['to']} ({rel['type']}) "
-                    f"Context: {rel['context']}"
-                    for rel in entity['relations']
-                ])
-                for entity in entities
-            ])
-            sections.append(entity_section)
-        
-        # Process Category Hierarchies
-        hierarchies = [item['category_hierarchy'] for item in context if 'category_hierarchy' in item]
-        if hierarchies:
-            hierarchy_section = "CATEGORY HIERARCHIES:\n" + "\n".join([
-                f"Category: {h['category']}\n"
-                f"Parent: {h['parent']}\n"
-                f"Description: {h['description']}"
-                for h in hierarchies
-            ])
-            sections.append(hierarchy_section)
+        for item in context:
+            # Process FAQs
+            faq = item.get('faq')
+            if faq is not None:
+                if faq_parts:
+                    faq_parts.append("\n\n")
+                faq_parts.append(
+                    f"Q: {faq['question']}\n"
+                    f"A: {faq['answer']}\n"
+                    f"Category: {faq.get('category', 'General')}\n"
+                    f"Match Type: {faq.get('match_type', 'direct')}"
+                )
+            
+            # Process Entities
+            entity = item.get('entity')
+            if entity is not None:
+                properties = entity['properties']
+                relations = entity['relations']
+                if entity_parts:
+                    entity_parts.append("\n\n")
+                entity_parts.append(f"Entity: {entity['name']} (Type: {entity['type']})\nProperties:\n")
+                entity_parts.append("\n".join(
+                    f"- {key}: {value['value']} (Metadata: {value['metadata']})"
+                    for key, value in properties.items()
+                ))
+                entity_parts.append("\nRelationships:\n")
+                entity_parts.append("\n".join(
+                    f"- {rel['to']} ({rel['type']}) Context: {rel['context']}"
+                    for rel in relations
+                ))
+            
+            # Process Category Hierarchies
+            h = item.get('category_hierarchy')
+            if h is not None:
+                if hierarchy_parts:
+                    hierarchy_parts.append("\n")
+                hierarchy_parts.append(
+                    f"Category: {h['category']}\n"
+                    f"Parent: {h['parent']}\n"
+                    f"Description: {h['description']}"
+                )
+            
+            # Process Context Relationships
+            rel = item.get('context_relationship')
+            if rel is not None:
+                if context_rel_parts:
+                    context_rel_parts.append("\n")
+                context_rel_parts.append(f"- {rel['context']} (Weight: {rel['weight']})")
         
-        # Process Context Relationships
-        context_rels = [item['context_relationship'] for item in context if 'context_relationship' in item]
-        if context_rels:
-            context_section = "CONTEXTUAL RELATIONSHIPS:\n" + "\n".join([
-                f"- {rel['context']} (Weight: {rel['weight']})"
-                for rel in context_rels
-            ])
-            sections.append(context_section)
+        sections = []
+        for header, parts in (("RELEVANT FAQs:\n", faq_parts),
+                              ("RELEVANT ENTITIES:\n", entity_parts),
+                              ("CATEGORY HIERARCHIES:\n", hierarchy_parts),
+                              ("CONTEXTUAL RELATIONSHIPS:\n", context_rel_parts)):
+            if parts:
+                sections.append(header + "".join(parts))
         
         return "\n\n".join(sections)
     
@@ -258,9 +335,9 @@ Your response should be informative, accurate, and helpful.
         """Format chat history into a structured string."""
         if not history:
             return ""
-            
+        
         return "Previous conversation:\n" + "\n\n".join([
             f"User: {h['user']}\n"
             f"Assistant: {h['assistant']}"
             for h in history
-        ]) 
\ No newline at end of file
+        ])
@@ -1,19 +1,60 @@
-from typing import List, Dict, Any, Optional, Union, BinaryIO
+from typing import List, Dict, Any, Optional, Union, BinaryIO, AsyncIterator, Tuple
 import os
-import base64
-from groq import Groq  # New library!
+import asyncio
+import logging
+from groq import AsyncGroq  # New library!
 from dotenv import load_dotenv
 import re
 
+from chat.cache import DiskCache, LRUCache, QuestionCache
+from chat.media import encode_base64
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Initialize Groq client
-client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"))
+
+# Maximum number of Groq requests in flight for a single batch
+MAX_CONCURRENT_REQUESTS = 5
+
+# Technical terms highlighted with <code> tags in plain-text responses
+TECH_TERMS = ["MeTTa", "GraphRAG", "Knowledge Graph", "Gemini", "Neo4j", "Entity Extraction",
+              "Multimodal", "LLM", "RAG", "API"]
+
+# Phrases linked to their reference pages in plain-text responses
+REFERENCE_LINKS = {
+    "MeTTa documentation": "https://github.com/trueagi-io/metta",
+    "Gemini API": "https://ai.google.dev/gemini-api",
+    "Neo4j": "https://neo4j.com/",
+}
+
+# Precompiled patterns for response post-processing
+_IMAGE_RE = re.compile(r'\[IMAGE:\s*(.*?)\]')
+_DEFINITION_RE = re.compile(r'([A-Z][a-zA-Z\s]+):\s([^\.]+\.)')
+_TECH_TERM_RE = re.compile(r'\b(' + '|'.join(map(re.escape, TECH_TERMS)) + r')\b')
+_LINK_RE = re.compile('|'.join(map(re.escape, sorted(REFERENCE_LINKS, key=len, reverse=True))))
 
 class VisionLLM:
-    def __init__(self, model_name: str = "llama-3.2-11b-vision-preview"):
-        """Initialize the Vision LLM with Groq's model."""
+    def __init__(self, model_name: str = "llama-3.2-11b-vision-preview",
+                 temperature: Optional[float] = None,
+                 cache_questions: bool = False):
+        """
+        Initialize the Vision LLM with Groq's model.
+        
+        Args:
+            model_name: The Groq model to use
+            temperature: Sampling temperature (None uses Groq's default); responses to
+                         exact prompts are only cached when it is 0, as sampled output varies
+            cache_questions: Reuse the answer to a question asked again (ignoring case and punctuation) with the same context
+        """
         self.model_name = model_name
+        self.temperature = temperature
+        self.question_cache = QuestionCache() if cache_questions else None
+        
+        # Responses to exact prompts: prompt hash -> raw response text (deterministic requests only)
+        self._response_cache = LRUCache(maxsize=1024) if temperature == 0 else None
         
     async def generate_response(self, 
                               question: str, 
@@ -32,6 +73,71 @@ class VisionLLM:
         Returns:
             str: Generated response
         """
+        prompt, cache_key, cache_scope, text = self._prepare_request(question, context, history, media_files)
+        
+        try:
+            if text is None:
+                # Prepare content for Groq API (base64-encoding images off the event loop)
+                content = await asyncio.to_thread(self._build_content, prompt, media_files)
+                
+                # Generate response using Groq, collecting the streamed text
+                text = "".join([delta async for delta in self._stream_completion(content)])
+                self._store_response(question, text, cache_key, cache_scope)
+            
+            # Process the response to ensure HTML formatting (off the event loop)
+            return await asyncio.to_thread(self._ensure_html_formatting, text)
+        except Exception as e:
+            logger.error("Error generating response: %s", e)
+            return f"I'm sorry, I encountered an error processing your request: {str(e)}"
+    
+    async def stream_response(self, 
+                              question: str, 
+                              context: List[Dict[str, Any]], 
+                              history: Optional[List[Dict[str, str]]] = None,
+                              media_files: Optional[List[Dict[str, Any]]] = None) -> AsyncIterator[str]:
+        """
+        Stream a response from Groq's vision model as it is generated.
+        Always yields the model's raw text (cached responses included), without the
+        post-processing generate_response applies; callers format the joined text if needed.
+        If the request fails before any text was yielded, an apology message is yielded
+        instead; failures part-way through the stream are raised.
+        
+        Args:
+            question: User's question
+            context: Relevant context from knowledge graph
+            history: Chat history for context
+            media_files: List of media files (images, etc.)
+            
+        Yields:
+            str: Pieces of the generated response
+        """
+        prompt, cache_key, cache_scope, cached_text = self._prepare_request(question, context, history, media_files)
+        if cached_text is not None:
+            yield cached_text
+            return
+        
+        parts = []
+        try:
+            content = await asyncio.to_thread(self._build_content, prompt, media_files)
+            
+            async for delta in self._stream_completion(content):
+                parts.append(delta)
+                yield delta
+        except Exception as e:
+            logger.error("Error generating response: %s", e)
+            if parts:
+                raise
+            yield f"I'm sorry, I encountered an error processing your request: {str(e)}"
+            return
+        
+        self._store_response(question, "".join(parts), cache_key, cache_scope)
+    
+    def _prepare_request(self, 
+                         question: str, 
+                         context: List[Dict[str, Any]], 
+                         history: Optional[List[Dict[str, str]]],
+                         media_files: Optional[List[Dict[str, Any]]]) -> Tuple[str, Optional[str], Optional[str], Optional[str]]:
+        """Build the prompt and cache keys for a request, along with any cached (unformatted) response text for it."""
         # Format context for the prompt
         context_str = self._format_context(context)
         
@@ -71,33 +177,78 @@ IMPORTANT: Return the HTML directly, NOT wrapped in markdown code blocks. Do not
 Your response should be informative, accurate, and helpful.
 """
         
-        try:
-            # Prepare content for Groq API
-            content = [{"type": "text", "text": prompt}]
-            
-            # Add media files if provided
-            if media_files and len(media_files) > 0:
-                for media_file in media_files:
-                    if media_file['type'] == 'image':
-                        image_base64 = base64.b64encode(media_file['data']).decode('utf-8')
-                        content.append({
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}
-                        })
-            
-            # Generate response using Groq
-            response = client.chat.completions.create(
-                model=self.model_name,
-                messages=[{"role": "user", "content": content}]
+        # Return the stored response if this exact prompt (and media) was answered before
+        cache_key = None
+        cached_response = None
+        if self._response_cache is not None:
+            cache_key = DiskCache.make_key(
+                self.model_name, prompt,
+                *[media_file['data'] for media_file in media_files or []]
             )
+            cached_response = self._response_cache.get(cache_key)
+            if cached_response is not None:
+                return prompt, cache_key, None, cached_response
+        
+        # Reuse the answer to the same question asked with the same context (media questions are never cached)
+        cache_scope = None
+        if self.question_cache is not None and not media_files:
+            cache_scope = DiskCache.make_key(self.model_name, context_str, history_str)
+            cached_response = self.question_cache.get(question, scope=cache_scope)
+        
+        return prompt, cache_key, cache_scope, cached_response
+    
+    def _store_response(self, question: str, text: str, cache_key: Optional[str], cache_scope: Optional[str]):
+        """Cache raw response text for its exact prompt and for its normalized question, where enabled."""
+        if cache_key is not None:
+            self._response_cache.set(cache_key, text)
+        if cache_scope is not None:
+            self.question_cache.set(question, text, scope=cache_scope)
+    
+    def _build_content(self, prompt: str, media_files: Optional[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """Build the Groq message content: the prompt followed by any images."""
+        content = [{"type": "text", "text": prompt}]
+        
+        # Add media files if provided
+        if media_files and len(media_files) > 0:
+            for media_file in media_files:
+                if media_file['type'] == 'image':
+                    image_base64 = encode_base64(media_file['data'])
+                    content.append({
+                        "type": "image_url",
+                        "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}
+                    })
+        
+        return content
+    
+    async def _stream_completion(self, content: List[Dict[str, Any]]) -> AsyncIterator[str]:
+        """Stream the text of a Groq chat completion as it is generated."""
+        stream = await client.chat.completions.create(
+            model=self.model_name,
+            messages=[{"role": "user", "content": content}],
+            stream=True,
+            **({"temperature": self.temperature} if self.temperature is not None else {})
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    
+    async def generate_batch(self, items: List[Dict[str, Any]]) -> List[str]:
+        """
+        Generate responses for several questions concurrently.
+        
+        Args:
+            items: Keyword arguments for generate_response, one dict per question
             
-            # Process the response to ensure HTML formatting
-            formatted_response = self._ensure_html_formatting(response.choices[0].message.content)
-            
-            return formatted_response
-        except Exception as e:
-            print(f"Error generating response: {str(e)}")
-            return f"I'm sorry, I encountered an error processing your request: {str(e)}"
+        Returns:
+            List of generated responses, one per item (in the same order)
+        """
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        return await asyncio.gather(*[self._generate_limited(item, semaphore) for item in items])
+    
+    async def _generate_limited(self, item: Dict[str, Any], semaphore: asyncio.Semaphore) -> str:
+        """Generate a response while holding the batch semaphore."""
+        async with semaphore:
+            return await self.generate_response(**item)
     
     def _ensure_html_formatting(self, text: str) -> str:
         """
@@ -110,25 +261,13 @@ Your response should be informative, accurate, and helpful.
         elif text.startswith("```") and text.endswith("```"):
             text = text[3:-3].strip()
         
-        # Process image descriptions
-        image_pattern = r'\[IMAGE:\s*(.*?)\]'
-        
-        def replace_with_image(match):
-            description = match.group(1).strip()
-            if "graph" in description.lower() or "network" in description.lower():
-                return f'<img src="https://via.placeholder.com/600x400/4285F4/FFFFFF?text=Knowledge+Graph+Visualization" alt="{description}" />'
-            elif "hierarchy" in description.lower() or "tree" in description.lower():
-                return f'<img src="https://via.placeholder.com/600x400/34A853/FFFFFF?text=Hierarchy+Diagram" alt="{description}" />'
-            elif "flow" in description.lower() or "process" in description.lower():
-                return f'<img src="https://via.placeholder.com/600x400/FBBC05/FFFFFF?text=Process+Flow" alt="{description}" />'
-            elif "comparison" in description.lower():
-                return f'<img src="https://via.placeholder.com/600x400/EA4335/FFFFFF?text=Comparison+Chart" alt="{description}" />'
-            else:
-                return f'<img src="https://via.placeholder.com/600x400/9C27B0/FFFFFF?text=Visualization" alt="{description}" />'
-        
-        text = re.sub(image_pattern, replace_with_image, text)
+        # Process image descriptions (a response with placeholder images is HTML already)
+        if "[IMAGE:" in text:
+            text, image_count = _IMAGE_RE.subn(self._replace_with_image, text)
+            if image_count:
+                return text
         
-        # Check if the response already has HTML
+        # Check if the response already has HTML (the usual case), skipping the plain-text passes below
         if "<" in text and ">" in text:
             return text
         
@@ -136,25 +275,37 @@ Your response should be informative, accurate, and helpful.
         formatted_text = text
         
         # Format definitions
-        definition_pattern = r'([A-Z][a-zA-Z\s]+):\s([^\.]+\.)'
-        formatted_text = re.sub(definition_pattern, r'<div class="definition"><b>\1:</b> \2</div>', formatted_text)
+        formatted_text = _DEFINITION_RE.sub(r'<div class="definition"><b>\1:</b> \2</div>', formatted_text)
         
-        # Format technical terms
-        tech_terms = ["MeTTa", "GraphRAG", "Knowledge Graph", "Gemini", "Neo4j", "Entity Extraction", 
-                      "Multimodal", "LLM", "RAG", "API"]
-        for term in tech_terms:
-            formatted_text = re.sub(r'\b' + re.escape(term) + r'\b', r'<code>\g<0></code>', formatted_text)
+        # Format technical terms (all terms in a single pass)
+        formatted_text = _TECH_TERM_RE.sub(r'<code>\1</code>', formatted_text)
         
         # Add paragraph breaks
         formatted_text = "<p>" + formatted_text.replace("\n\n", "</p><p>") + "</p>"
         
-        # Add links
-        formatted_text = formatted_text.replace("MeTTa documentation", '<a href="https://github.com/trueagi-io/metta" target="_blank">MeTTa documentation</a>')
-        formatted_text = formatted_text.replace("Gemini API", '<a href="https://ai.google.dev/gemini-api" target="_blank">Gemini API</a>')
-        formatted_text = formatted_text.replace("Neo4j", '<a href="https://neo4j.com/" target="_blank">Neo4j</a>')
+        # Add links (all reference phrases in a single pass)
+        formatted_text = _LINK_RE.sub(
+            lambda m: f'<a href="{REFERENCE_LINKS[m.group(0)]}" target="_blank">{m.group(0)}</a>',
+            formatted_text
+        )
         
         return formatted_text
     
+    @staticmethod
+    def _replace_with_image(match: re.Match) -> str:
+        """Replace an [IMAGE: description] marker with a placeholder image."""
+        description = match.group(1).strip()
+        if "graph" in description.lower() or "network" in description.lower():
+            return f'<img src="https://via.placeholder.com/600x400/4285F4/FFFFFF?text=Knowledge+Graph+Visualization" alt="{description}" />'
+        elif "hierarchy" in description.lower() or "tree" in description.lower():
+            return f'<img src="https://via.placeholder.com/600x400/34A853/FFFFFF?text=Hierarchy+Diagram" alt="{description}" />'
+        elif "flow" in description.lower() or "process" in description.lower():
+            return f'<img src="https://via.placeholder.com/600x400/FBBC05/FFFFFF?text=Process+Flow" alt="{description}" />'
+        elif "comparison" in description.lower():
+            return f'<img src="https://via.placeholder.com/600x400/EA4335/FFFFFF?text=Comparison+Chart" alt="{description}" />'
+        else:
+            return f'<img src="https://via.placeholder.com/600x400/9C27B0/FFFFFF?text=Visualization" alt="{description}" />'
+    
     def _create_image_part(self, image_data: Union[bytes, BinaryIO], mime_type: str = None) -> Dict:
         """Create an image part for the Groq API."""
         try:
@@ -165,69 +316,86 @@ Your response should be informative, accurate, and helpful.
             
             mime_type = mime_type or "image/jpeg"
             
-            # Debug info (optional—remove if you don’t need it)
-            print(f"Image MIME: {mime_type}")
-            print(f"Image data length: {len(image_bytes)} bytes")
-            print(f"Base64 sample: {base64.b64encode(image_bytes).decode('utf-8')[:20]}...")
+            # Encode once and reuse the encoding for both the debug sample and the data URL
+            image_base64 = encode_base64(image_bytes)
+            
+            # Debug info (only formatted when debug logging is enabled)
+            logger.debug("Image MIME: %s", mime_type)
+            logger.debug("Image data length: %d bytes", len(image_bytes))
+            logger.debug("Base64 sample: %s...", image_base64[:20])
             
             return {
                 "type": "image_url",
-                "image_url": {"url": f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"}
+                "image_url": {"url": f"data:{mime_type};base64,{image_base64}"}
             }
         except Exception as e:
-            print(f"Error creating image part: {str(e)}")
+            logger.error("Error creating image part: %s", e)
             raise
     
     def _format_context(self, context: List[Dict[str, Any]]) -> str:
         """Format knowledge graph context into a structured string."""
-        sections = []
+        # Each section collects its pieces in one buffer and is joined once at the end
+        faq_parts = []
+        entity_parts = []
+        hierarchy_parts = []
+        context_rel_parts = []
+        
+        for item in context:
+            # Process FAQs
+            faq = item.get('faq')
+            if faq is not None:
+                if faq_parts:
+                    faq_parts.append("\n\n")
+                faq_parts.append(
+                    f"Q: {faq['question']}\n"
+                    f"A: {faq['answer']}\n"
+                    f"Category: {faq.get('category', 'General')}\n"
+                    f"Match Type: {faq.get('match_type', 'direct')}"
+                )
+            
+            # Process Entities
+            entity = item.get('entity')
+            if entity is not None:
+                properties = entity['properties']
+                relations = entity['relations']
+                if entity_parts:
+                    entity_parts.append("\n\n")
+                entity_parts.append(f"Entity: {entity['name']} (Type: {entity['type']})\nProperties:\n")
+                entity_parts.append("\n".join(
+                    f"- {key}: {value['value']} (Metadata: {value['metadata']})"
+                    for key, value in properties.items()
+                ))
+                entity_parts.append("\nRelationships:\n")
+                entity_parts.append("\n".join(
+                    f"- {rel['to']} ({rel['type']}) Context: {rel['context']}"
+                    for rel in relations
+                ))
+            
+            # Process Category Hierarchies
+            h = item.get('category_hierarchy')
+            if h is not None:
+                if hierarchy_parts:
+                    hierarchy_parts.append("\n")
+                hierarchy_parts.append(
+                    f"Category: {h['category']}\n"
+                    f"Parent: {h['parent']}\n"
+                    f"Description: {h['description']}"
+                )
+            
+            # Process Context Relationships
+            rel = item.get('context_relationship')
+            if rel is not None:
+                if context_rel_parts:
+                    context_rel_parts.append("\n")
+                context_rel_parts.append(f"- {rel['context']} (Weight: {rel['weight']})")
         
-        faqs = [item['faq'] for item in context if 'faq' in item]
-        if faqs:
-            faq_section = "RELEVANT FAQs:\n" + "\n\n".join([
-                f"Q: {faq['question']}\n"
-                f"A: {faq['answer']}\n"
-                f"Category: {faq.get('category', 'General')}\n"
-                f"Match Type: {faq.get('match_type', 'direct')}"
-                for faq in faqs
-            ])
-            sections.append(faq_section)
-        
-        entities = [item['entity'] for item in context if 'entity' in item]
-        if entities:
-            entity_section = "RELEVANT ENTITIES:\n" + "\n\n".join([
-                f"Entity: {entity['name']} (Type: {entity['type']})\n"
-                f"Properties:\n" + "\n".join([
-                    f"- {key}: {value['value']} "
-                    f"(Metadata: {value['metadata']})"
-                    for key, value in entity['properties'].items()
-                ]) + "\n"
-                f"Relationships:\n" + "\n".join([
-                    f"- {rel['to']} ({rel['type']}) "
-                    f"Context: {rel['context']}"
-                    for rel in entity['relations']
-                ])
-                for entity in entities
-            ])
-            sections.append(entity_section)
-        
-        hierarchies = [item['category_hierarchy'] for item in context if 'category_hierarchy' in item]
-        if hierarchies:
-            hierarchy_section = "CATEGORY HIERARCHIES:\n" + "\n".join([
-                f"Category: {h['category']}\n"
-                f"Parent: {h['parent']}\n"
-                f"Description: {h['description']}"
-                for h in hierarchies
-            ])
-            sections.append(hierarchy_section)
-        
-        context_rels = [item['context_relationship'] for item in context if 'context_relationship' in item]
-        if context_rels:
-            context_section = "CONTEXTUAL RELATIONSHIPS:\n" + "\n".join([
-                f"- {rel['context']} (Weight: {rel['weight']})"
-                for rel in context_rels
-            ])
-            sections.append(context_section)
+        sections = []
+        for header, parts in (("RELEVANT FAQs:\n", faq_parts),
+                              ("RELEVANT ENTITIES:\n", entity_parts),
+                              ("CATEGORY HIERARCHIES:\n", hierarchy_parts),
+                              ("CONTEXTUAL RELATIONSHIPS:\n", context_rel_parts)):
+            if parts:
+                sections.append(header + "".join(parts))
         
         return "\n\n".join(sections)
     
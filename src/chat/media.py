@@ -0,0 +1,84 @@
+from typing import Dict, Optional, Tuple
+from functools import lru_cache
+from io import BytesIO
+import base64
+import hashlib
+
+from PIL import Image, ImageOps
+
+from chat.cache import LRUCache
+
+# Longest side, in pixels, images are downscaled to before being sent to the model
+# (vision encoders tile images well below this resolution anyway)
+MAX_IMAGE_SIZE = 1024
+
+# Recently encoded images, keyed by content hash (the same image is often resent across turns).
+# Only data up to MAX_CACHED_BASE64_SIZE bytes is cached, which bounds the cache to a few MB;
+# for larger data hashing costs about as much as encoding, so it is simply re-encoded.
+MAX_CACHED_BASE64_SIZE = 256 * 1024
+_base64_cache = LRUCache(maxsize=32)
+
+def encode_base64(data: bytes) -> str:
+    """Base64-encode media data, reusing the encoding for recently seen small content."""
+    if len(data) > MAX_CACHED_BASE64_SIZE:
+        return base64.b64encode(data).decode('ascii')
+    
+    key = hashlib.blake2b(data, digest_size=16).digest()
+    encoded = _base64_cache.get(key)
+    if encoded is None:
+        encoded = base64.b64encode(data).decode('ascii')
+        _base64_cache.set(key, encoded)
+    return encoded
+
+@lru_cache(maxsize=64)
+def _sniff_header(header: bytes) -> Optional[str]:
+    """Identify an image format from its leading magic bytes."""
+    if header[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if header[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if header[:4] == b'GIF8':
+        return 'image/gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+def sniff_image_mime_type(data: bytes, default: str = "image/jpeg") -> str:
+    """Detect the MIME type of image data from its magic bytes, falling back to default."""
+    return _sniff_header(bytes(data[:12])) or default
+
+def downscale_image(image_bytes: bytes, mime_type: str, max_size: int = MAX_IMAGE_SIZE) -> Tuple[bytes, str]:
+    """
+    Shrink an image so its longest side is at most max_size pixels, returning the new data and MIME type.
+    Images that are already small enough, animated or undecodable are returned unchanged.
+    """
+    try:
+        with Image.open(BytesIO(image_bytes)) as image:
+            if max(image.size) <= max_size or getattr(image, 'is_animated', False):
+                return image_bytes, mime_type
+            
+            # Keep transparency as PNG; everything else is re-encoded as JPEG
+            has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+            
+            # Apply the EXIF orientation (e.g. of phone photos), as the tag is not kept when re-encoding
+            image = ImageOps.exif_transpose(image)
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+            image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+            
+            buffer = BytesIO()
+            if has_alpha:
+                image.save(buffer, format='PNG')
+                return buffer.getvalue(), 'image/png'
+            image.save(buffer, format='JPEG', quality=85)
+            return buffer.getvalue(), 'image/jpeg'
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return image_bytes, mime_type
+
+def create_image_part(image_bytes: bytes, mime_type: str) -> Dict:
+    """Create an inline image part for the Gemini API."""
+    return {
+        "inline_data": {
+            "mime_type": mime_type,
+            "data": encode_base64(image_bytes)
+        }
+    }
@@ -1,90 +1,199 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterable, Optional, Tuple
+from functools import lru_cache
+from itertools import chain
 from hyperon import MeTTa, E, S, V, G
+import logging
 import re
+import threading
+
+from chat.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Punctuation stripped from text before splitting it into terms, with an equivalent
+# translation table for the common all-ASCII case (str.translate is much cheaper than re.sub)
+_PUNCT_RE = re.compile(r'[^\w\s]')
+_ASCII_PUNCT = ''.join(c for c in map(chr, range(128)) if _PUNCT_RE.match(c))
+_ASCII_PUNCT_TABLE = str.maketrans(_ASCII_PUNCT, ' ' * len(_ASCII_PUNCT))
+
+# MeTTa queries, batched into a single program per step of query_context.
+# Placeholders are filled with string literals built by _quote.
+_ALL_FAQS_QUERY = '(match &self (FAQ $question $answer $category $concepts) (FAQEntry $question $answer $category))'
+_FAQS_BY_CATEGORY_QUERY = '(GetFAQsByCategory {})'
+_ENTITY_QUERY = '(match &self (Entity {0} $type) (EntityInfo {0} $type))'
+_PROPERTIES_QUERY = '(GetPropertiesWithMetadata {})'
+_RELATIONS_QUERY = '(GetRelatedWithContext {})'
+_SYNONYMS_QUERY = '(FindSimilarTerms {})'
+_HIERARCHY_QUERY = '(GetCategoryHierarchy {})'
+_WEIGHTED_CONTEXT_QUERY = '(GetWeightedContext {})'
+
+def _quote(text: Any) -> str:
+    """
+    Build a MeTTa string literal, escaping backslashes and quotes so text can't break out of it.
+    Non-string values are converted with str(); None becomes an empty string.
+    """
+    text = "" if text is None else str(text)
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
 
 class GraphRAG:
-    def __init__(self):
-        """Initialize MeTTa engine and load knowledge graph."""
+    def __init__(self, schema_file: Optional[str] = None, data_file: Optional[str] = None, prefetch: bool = False):
+        """
+        Initialize MeTTa engine and load knowledge graph.
+        
+        Args:
+            schema_file: Optional knowledge graph schema to load
+            data_file: Optional knowledge graph data to load
+            prefetch: Load the files (and build the FAQ index) in a background thread;
+                      queries and updates wait until loading has finished
+        """
         self.metta = MeTTa()
         
+        # Per-term query results, cleared whenever the knowledge graph changes
+        self._synonym_cache = LRUCache(maxsize=4096)
+        self._hierarchy_cache = LRUCache(maxsize=4096)
+        # Full context per question (and extra concepts), also cleared whenever the knowledge graph changes
+        self._context_cache = LRUCache(maxsize=4096)
+        
+        # Inverted index of FAQ terms (term -> FAQ ids), built on first use and after FAQs change
+        self._faqs = []
+        self._faq_index = None
+        
+        # Set once the knowledge graph is ready for queries and updates
+        self._ready = threading.Event()
+        # Serializes access to the MeTTa space, which is queried and updated from worker threads
+        self._lock = threading.RLock()
+        if schema_file and data_file and prefetch:
+            threading.Thread(target=self._prefetch, args=(schema_file, data_file), daemon=True).start()
+        else:
+            if schema_file and data_file:
+                self.load_knowledge_base(schema_file, data_file)
+            self._ready.set()
+        
     def load_knowledge_base(self, schema_file: str, data_file: str):
         """Load knowledge graph schema and data."""
-        # Load schema
+        # Read schema and data
         with open(schema_file, 'r') as f:
-            self.metta.run(f.read())
-            
-        # Load data
+            schema = f.read()
         with open(data_file, 'r') as f:
-            self.metta.run(f.read())
+            data = f.read()
+        
+        # Load both as a single program so MeTTa is only invoked once
+        with self._lock:
+            self.metta.run(schema + "\n" + data)
+            self._clear_query_caches()
+            self._faq_index = None
     
-    def query_context(self, question: str) -> List[Dict[str, Any]]:
+    def _prefetch(self, schema_file: str, data_file: str):
+        """Load the knowledge graph and build the FAQ index in the background."""
+        try:
+            self.load_knowledge_base(schema_file, data_file)
+            with self._lock:
+                self._build_faq_index()
+        except Exception as e:
+            logger.error("Error loading knowledge base: %s", e)
+        finally:
+            self._ready.set()
+    
+    def query_context(self, question: str, extra_concepts: Optional[List[str]] = None) -> List[Dict[str, Any]]:
         """
         Query the knowledge graph for relevant context based on the question.
         Uses multiple strategies to find relevant information.
+        
+        Args:
+            question: The user's question
+            extra_concepts: Optional additional concepts (e.g. entity names extracted
+                            from images) whose terms are looked up alongside the question's
         """
+        self._ready.wait()
+        key = (question, tuple(extra_concepts or ()))
+        with self._lock:
+            context = self._context_cache.get(key)
+            if context is None:
+                context = self._query_context(question, key[1])
+                self._context_cache.set(key, context)
+        # Callers may extend the returned list, so never hand out the cached one
+        return list(context)
+    
+    def _query_context(self, question: str, extra_concepts: Iterable[str]) -> List[Dict[str, Any]]:
+        """Run all context lookups for a question; the caller holds the lock."""
         context = []
         
+        # Deduplicate terms so repeated words don't trigger identical queries
+        terms = tuple(dict.fromkeys(chain(
+            self._extract_terms(question),
+            *(self._extract_terms(concept) for concept in extra_concepts)
+        )))
+        
+        # Synonyms are cached per term, so only look up the ones not seen before
+        synonyms_by_term = {term: self._synonym_cache.get(term) for term in terms}
+        synonym_terms = [term for term, synonyms in synonyms_by_term.items() if synonyms is None]
+        
+        # Run the FAQ category, entity, synonym and context queries for every term as a single MeTTa program
+        results = iter(self._run_queries([
+            *[_FAQS_BY_CATEGORY_QUERY.format(_quote(term)) for term in terms],
+            *[_ENTITY_QUERY.format(_quote(term)) for term in terms],
+            *[_SYNONYMS_QUERY.format(_quote(term)) for term in synonym_terms],
+            *[_WEIGHTED_CONTEXT_QUERY.format(_quote(term)) for term in terms]
+        ]))
+        category_faq_matches = [next(results) for _ in terms]
+        entity_matches = [match for _ in terms for match in next(results)]
+        for term in synonym_terms:
+            synonyms_by_term[term] = self._synonyms_from_matches(next(results))
+            self._synonym_cache.set(term, synonyms_by_term[term])
+        context_matches = [match for _ in terms for match in next(results)]
+        
         # 1. Direct FAQ matches
-        faq_matches = self._query_faqs(question)
-        context.extend(faq_matches)
+        context.extend(self._query_faqs(terms, category_faq_matches))
         
         # 2. Entity and concept matches
-        entity_matches = self._query_entities(question)
-        context.extend(entity_matches)
-        
-        # 3. Find related concepts through synonyms
-        synonym_matches = self._query_synonyms(question)
-        for synonym in synonym_matches:
-            # Query entities and FAQs using synonyms
-            context.extend(self._query_entities(synonym['term']))
+        # 3. Find related concepts through synonyms (queried together with the question's entities),
+        #    skipping terms whose entities have already been looked up
+        seen_terms = set(terms)
+        synonym_entity_terms = []
+        for term in terms:
+            for synonym in synonyms_by_term[term]:
+                for entity_term in self._extract_terms(synonym['term']):
+                    if entity_term not in seen_terms:
+                        seen_terms.add(entity_term)
+                        synonym_entity_terms.append(entity_term)
+        for matches in self._run_queries([_ENTITY_QUERY.format(_quote(term)) for term in synonym_entity_terms]):
+            entity_matches.extend(matches)
+        context.extend(self._entities_from_matches(entity_matches))
         
         # 4. Get category hierarchies for relevant concepts
         categories = self._extract_categories(context)
-        for category in categories:
-            hierarchy = self._query_category_hierarchy(category)
+        for hierarchy in self._query_category_hierarchies(categories):
             if hierarchy:
                 context.append({'category_hierarchy': hierarchy})
         
         # 5. Get weighted context relationships
-        context_relationships = self._query_context_relationships(question)
-        context.extend(context_relationships)
+        context.extend(self._context_relationships_from_matches(context_matches))
         
         return context
     
-    def _query_faqs(self, query: str) -> List[Dict[str, Any]]:
-        """Query FAQs using direct matching."""
+    def _run_queries(self, queries: List[str]) -> List[List[Any]]:
+        """Run several MeTTa queries as one program, returning the results of each query in order."""
+        if not queries:
+            return []
+        return self.metta.run("\n".join(f"! {query}" for query in queries))
+    
+    def _query_faqs(self, query_terms: Tuple[str, ...], category_faq_matches: List[List[Any]]) -> List[Dict[str, Any]]:
+        """Look up FAQs containing any of the query terms, followed by the FAQs of matching categories."""
         results = []
         
-        # Get all FAQs
-        faq_matches = self.metta.run(f'''
-            ! (match &self (FAQ $question $answer $category $concepts)
-                (FAQEntry $question $answer $category))
-        ''')[0]
-        
-        # Filter FAQs based on relevance to query
-        for match in faq_matches:
-            question = str(match.get_children()[0])
-            answer = str(match.get_children()[1])
-            category = str(match.get_children()[2])
-            
-            # Simple relevance check - if query terms appear in question or answer
-            if self._is_relevant(query, question) or self._is_relevant(query, answer):
-                results.append({
-                    'faq': {
-                        'question': question,
-                        'answer': answer,
-                        'category': category,
-                        'match_type': 'direct'
-                    }
-                })
+        # Direct matches: FAQs whose question or answer contains a query term
+        if self._faq_index is None:
+            self._build_faq_index()
+        faqs, faq_index = self._faqs, self._faq_index
+        faq_ids = set()
+        for term in query_terms:
+            faq_ids.update(faq_index.get(term, ()))
+        
+        for faq_id in sorted(faq_ids):
+            results.append({'faq': {**faqs[faq_id], 'match_type': 'direct'}})
         
         # Get FAQs by category if any terms match category names
-        terms = self._extract_terms(query)
-        for term in terms:
-            category_matches = self.metta.run(f'''
-                ! (GetFAQsByCategory "{term}")
-            ''')[0]
-            
+        for category_matches in category_faq_matches:
             for match in category_matches:
                 results.append({
                     'faq': {
@@ -96,128 +205,119 @@ class GraphRAG:
         
         return results
     
-    def _is_relevant(self, query: str, text: str) -> bool:
-        """Check if query is relevant to text using simple term matching."""
-        query_terms = self._extract_terms(query.lower())
-        text_lower = text.lower()
+    def _build_faq_index(self):
+        """Read all FAQs from the knowledge graph and index them by the terms of their question and answer."""
+        faqs = []
+        faq_index = {}
         
-        for term in query_terms:
-            if term in text_lower:
-                return True
-        return False
-    
-    def _query_entities(self, query: str) -> List[Dict[str, Any]]:
-        """Query entities and their relationships."""
-        results = []
+        for match in self._run_queries([_ALL_FAQS_QUERY])[0]:
+            # Children are (FAQEntry question answer category)
+            question, answer, category = (str(child) for child in match.get_children()[1:4])
+            faq_id = len(faqs)
+            faqs.append({
+                'question': question,
+                'answer': answer,
+                'category': category
+            })
+            for term in set(self._extract_terms(question + " " + answer)):
+                faq_index.setdefault(term, []).append(faq_id)
         
-        # Extract terms for entity matching
-        terms = self._extract_terms(query)
-        for term in terms:
-            # Query entities
-            entity_matches = self.metta.run(f'''
-                ! (match &self 
-                    (Entity "{term}" $type)
-                    (EntityInfo "{term}" $type))
-            ''')[0]
-            
-            for match in entity_matches:
-                entity_name = str(match.get_children()[0])
-                
-                # Get entity properties with metadata
-                properties = self.metta.run(f'''
-                    ! (GetPropertiesWithMetadata "{entity_name}")
-                ''')[0]
-                
-                # Get related entities with context
-                relations = self.metta.run(f'''
-                    ! (GetRelatedWithContext "{entity_name}")
-                ''')[0]
-                
-                results.append({
-                    'entity': {
-                        'name': entity_name,
-                        'type': str(match.get_children()[1]),
-                        'properties': {
-                            str(prop.get_children()[0]): {
-                                'value': str(prop.get_children()[1]),
-                                'metadata': str(prop.get_children()[2])
-                            }
-                            for prop in properties
-                        },
-                        'relations': [
-                            {
-                                'to': str(rel.get_children()[0]),
-                                'type': str(rel.get_children()[1]),
-                                'context': str(rel.get_children()[2])
-                            }
-                            for rel in relations
-                        ]
-                    }
-                })
-        
-        return results
+        self._faqs, self._faq_index = faqs, faq_index
     
-    def _query_synonyms(self, query: str) -> List[Dict[str, Any]]:
-        """Find synonyms and semantic equivalents."""
+    def _entities_from_matches(self, entity_matches: List[Any]) -> List[Dict[str, Any]]:
+        """Build entity results, fetching the properties and relations of all entities in one program."""
         results = []
-        terms = self._extract_terms(query)
+        entity_names = [str(match.get_children()[0]) for match in entity_matches]
         
-        for term in terms:
-            synonym_matches = self.metta.run(f'''
-                ! (FindSimilarTerms "{term}")
-            ''')[0]
+        # Get entity properties with metadata and related entities with context
+        details = iter(self._run_queries([
+            query
+            for entity_name in entity_names
+            for query in (_PROPERTIES_QUERY.format(_quote(entity_name)), _RELATIONS_QUERY.format(_quote(entity_name)))
+        ]))
+        
+        for match, entity_name in zip(entity_matches, entity_names):
+            properties = next(details)
+            relations = next(details)
             
-            for match in synonym_matches:
-                results.append({
-                    'term': str(match.get_children()[0]),
-                    'confidence': float(match.get_children()[1])
-                })
+            results.append({
+                'entity': {
+                    'name': entity_name,
+                    'type': str(match.get_children()[1]),
+                    'properties': {
+                        str(prop.get_children()[0]): {
+                            'value': str(prop.get_children()[1]),
+                            'metadata': str(prop.get_children()[2])
+                        }
+                        for prop in properties
+                    },
+                    'relations': [
+                        {
+                            'to': str(rel.get_children()[0]),
+                            'type': str(rel.get_children()[1]),
+                            'context': str(rel.get_children()[2])
+                        }
+                        for rel in relations
+                    ]
+                }
+            })
         
         return results
     
-    def _query_category_hierarchy(self, category: str) -> Optional[Dict[str, Any]]:
-        """Get category hierarchy information."""
-        hierarchy_matches = self.metta.run(f'''
-            ! (GetCategoryHierarchy "{category}")
-        ''')[0]
-        
-        if hierarchy_matches:
-            match = hierarchy_matches[0]
-            return {
-                'category': category,
-                'parent': str(match.get_children()[0]),
-                'description': str(match.get_children()[1])
+    def _synonyms_from_matches(self, synonym_matches: List[Any]) -> List[Dict[str, Any]]:
+        """Build synonym results (similar terms with confidence)."""
+        return [
+            {
+                'term': str(match.get_children()[0]),
+                'confidence': float(match.get_children()[1])
             }
-        return None
+            for match in synonym_matches
+        ]
     
-    def _query_context_relationships(self, query: str) -> List[Dict[str, Any]]:
-        """Get weighted context relationships."""
-        results = []
-        terms = self._extract_terms(query)
+    def _query_category_hierarchies(self, categories: List[str]) -> List[Optional[Dict[str, Any]]]:
+        """Get category hierarchy information for several categories, querying all uncached ones in one program."""
+        # Cached as 1-tuples so categories without a hierarchy are cached too
+        hierarchies = {category: self._hierarchy_cache.get(category) for category in categories}
+        uncached = [category for category, cached in hierarchies.items() if cached is None]
         
-        for term in terms:
-            context_matches = self.metta.run(f'''
-                ! (GetWeightedContext "{term}")
-            ''')[0]
-            
-            for match in context_matches:
-                results.append({
-                    'context_relationship': {
-                        'context': str(match.get_children()[0]),
-                        'weight': float(match.get_children()[1])
-                    }
-                })
+        for category, hierarchy_matches in zip(uncached, self._run_queries(
+                [_HIERARCHY_QUERY.format(_quote(category)) for category in uncached])):
+            hierarchy = None
+            if hierarchy_matches:
+                match = hierarchy_matches[0]
+                hierarchy = {
+                    'category': category,
+                    'parent': str(match.get_children()[0]),
+                    'description': str(match.get_children()[1])
+                }
+            hierarchies[category] = (hierarchy,)
+            self._hierarchy_cache.set(category, hierarchies[category])
         
-        return results
+        return [hierarchies[category][0] for category in categories]
+    
+    def _context_relationships_from_matches(self, context_matches: List[Any]) -> List[Dict[str, Any]]:
+        """Build weighted context relationship results."""
+        return [
+            {
+                'context_relationship': {
+                    'context': str(match.get_children()[0]),
+                    'weight': float(match.get_children()[1])
+                }
+            }
+            for match in context_matches
+        ]
     
-    def _extract_terms(self, text: str) -> List[str]:
-        """Extract key terms from text for entity matching."""
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _extract_terms(text: str) -> Tuple[str, ...]:
+        """Extract key terms from text for entity matching (memoized, so the result is a tuple)."""
         # Remove punctuation and convert to lowercase
-        text = re.sub(r'[^\w\s]', ' ', text.lower())
+        text = text.lower()
+        text = text.translate(_ASCII_PUNCT_TABLE) if text.isascii() else _PUNCT_RE.sub(' ', text)
         
         # Split into words and filter
         words = text.split()
-        return [word for word in words if len(word) > 3]  # Filter out short words
+        return tuple(word for word in words if len(word) > 3)  # Filter out short words
     
     def _extract_categories(self, context: List[Dict[str, Any]]) -> List[str]:
         """Extract unique categories from context."""
@@ -233,27 +333,119 @@ class GraphRAG:
     
     def add_faq(self, question: str, answer: str, category: str, concepts: List[str] = None):
         """Add a new FAQ entry to the knowledge graph."""
-        concepts_str = f'"{" ".join(concepts)}"' if concepts else '""'
-        self.metta.run(f'''
-            (FAQ "{question}" "{answer}" "{category}" {concepts_str})
-        ''')
+        self._add_atoms([self._faq_atom(question, answer, category, concepts)], faqs_changed=True)
     
     def add_entity(self, name: str, entity_type: str, properties: Dict[str, Dict[str, str]] = None):
         """Add a new entity with metadata to the knowledge graph."""
-        self.metta.run(f'''
-            (Entity "{name}" "{entity_type}")
-        ''')
+        self._add_atoms(self._entity_atoms(name, entity_type, properties))
+    
+    def add_relationship(self, from_entity: str, relationship_type: str, to_entity: str, context: str = ""):
+        """Add a new relationship with context between entities."""
+        self._add_atoms([self._relationship_atom(from_entity, relationship_type, to_entity, context)])
+    
+    def add_faqs_bulk(self, faqs: List[Dict[str, Any]]):
+        """
+        Add several FAQ entries to the knowledge graph in a single MeTTa run.
+        Malformed entries are logged and skipped without affecting the rest.
+        
+        Args:
+            faqs: Dicts with 'question', 'answer' and optional 'category' and 'concepts'
+                  (a list or space-separated string) keys, as produced by the AutoExtractor
+        """
+        atoms = []
+        for faq in faqs:
+            try:
+                if 'question' not in faq or 'answer' not in faq:
+                    logger.error("Skipping FAQ without question or answer: %s", faq)
+                    continue
+                concepts = faq.get('concepts')
+                if isinstance(concepts, str):
+                    concepts = concepts.split()
+                atoms.append(self._faq_atom(faq['question'], faq['answer'], faq.get('category', 'General'), concepts))
+            except Exception as e:
+                logger.error("Skipping invalid FAQ %s: %s", faq, e)
+        
+        self._add_atoms(atoms, faqs_changed=True)
+    
+    def add_entities_bulk(self, entities: List[Dict[str, Any]]):
+        """
+        Add several entities to the knowledge graph in a single MeTTa run.
+        Malformed entities are logged and skipped without affecting the rest.
+        
+        Args:
+            entities: Dicts with 'name', 'type' and optional 'properties' keys,
+                      as produced by the AutoExtractor
+        """
+        atoms = []
+        for entity in entities:
+            try:
+                if 'name' not in entity or 'type' not in entity:
+                    logger.error("Skipping entity without name or type: %s", entity)
+                    continue
+                atoms.extend(self._entity_atoms(entity['name'], entity['type'], entity.get('properties', {})))
+            except Exception as e:
+                logger.error("Skipping invalid entity %s: %s", entity, e)
         
+        self._add_atoms(atoms)
+    
+    def add_relationships_bulk(self, relationships: List[Dict[str, str]]):
+        """
+        Add several relationships to the knowledge graph in a single MeTTa run.
+        Malformed relationships are logged and skipped without affecting the rest.
+        
+        Args:
+            relationships: Dicts with 'from_entity', 'relationship_type', 'to_entity'
+                           and optional 'context' keys, as produced by the AutoExtractor
+        """
+        atoms = []
+        for rel in relationships:
+            try:
+                if 'from_entity' not in rel or 'relationship_type' not in rel or 'to_entity' not in rel:
+                    logger.error("Skipping incomplete relationship: %s", rel)
+                    continue
+                atoms.append(self._relationship_atom(
+                    rel['from_entity'], rel['relationship_type'], rel['to_entity'], rel.get('context', '')
+                ))
+            except Exception as e:
+                logger.error("Skipping invalid relationship %s: %s", rel, e)
+        
+        self._add_atoms(atoms)
+    
+    def _add_atoms(self, atoms: List[str], faqs_changed: bool = False):
+        """Add atoms to the knowledge graph in a single MeTTa run and invalidate cached query results."""
+        if not atoms:
+            return
+        self._ready.wait()
+        with self._lock:
+            self.metta.run("\n".join(atoms))
+            self._clear_query_caches()
+            if faqs_changed:
+                self._faq_index = None
+    
+    @staticmethod
+    def _faq_atom(question: str, answer: str, category: str, concepts: List[str] = None) -> str:
+        """Build the MeTTa atom for an FAQ entry."""
+        concepts_str = _quote(" ".join(concepts) if concepts else "")
+        return f'(FAQ {_quote(question)} {_quote(answer)} {_quote(category)} {concepts_str})'
+    
+    @staticmethod
+    def _entity_atoms(name: str, entity_type: str, properties: Dict[str, Dict[str, str]] = None) -> List[str]:
+        """Build the MeTTa atoms for an entity and its properties."""
+        atoms = [f'(Entity {_quote(name)} {_quote(entity_type)})']
         if properties:
             for key, value_data in properties.items():
                 value = value_data.get('value', '')
                 metadata = value_data.get('metadata', '')
-                self.metta.run(f'''
-                    (Property "{name}" "{key}" "{value}" "{metadata}")
-                ''')
+                atoms.append(f'(Property {_quote(name)} {_quote(key)} {_quote(value)} {_quote(metadata)})')
+        return atoms
     
-    def add_relationship(self, from_entity: str, relationship_type: str, to_entity: str, context: str = ""):
-        """Add a new relationship with context between entities."""
-        self.metta.run(f'''
-            (Relationship "{from_entity}" "{relationship_type}" "{to_entity}" "{context}")
-        ''') 
\ No newline at end of file
+    @staticmethod
+    def _relationship_atom(from_entity: str, relationship_type: str, to_entity: str, context: str = "") -> str:
+        """Build the MeTTa atom for a relationship."""
+        return f'(Relationship {_quote(from_entity)} {_quote(relationship_type)} {_quote(to_entity)} {_quote(context)})'
+    
+    def _clear_query_caches(self):
+        """Drop cached query results after the knowledge graph has changed."""
+        self._synonym_cache.clear()
+        self._hierarchy_cache.clear()
+        self._context_cache.clear() 
\ No newline at end of file
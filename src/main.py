@@ -1,16 +1,22 @@
 import os
-import json
-from typing import List, Dict, Optional, Any
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks
-from fastapi.responses import JSONResponse, FileResponse
+import asyncio
+import hashlib
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Dict, Optional, Any, Tuple
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks, Request
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter, field_validator
 from dotenv import load_dotenv
+import orjson
 
-from chat.llm import GeminiLLM
+from chat.llm import GeminiLLM, error_response
 from chat.rag import GraphRAG
 from chat.auto_extractor import AutoExtractor
+from chat.cache import QuestionCache
+from chat.media import downscale_image
 
 # Load environment variables
 load_dotenv()
@@ -19,43 +25,54 @@ load_dotenv()
 app = FastAPI(
     title="Domain-Specific FAQ Chatbot",
     description="A chatbot that combines knowledge graphs with LLM for enhanced FAQ responses",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
-# Add CORS middleware
+# Add CORS middleware (the demo page is served by this app and calls it on localhost:8000)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
+    allow_origins=["http://localhost:8000", "http://127.0.0.1:8000"],
+    allow_credentials=False,
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["content-type", "authorization"],
+    max_age=86400,  # Let browsers cache preflight responses for a day
 )
 
-# Initialize components
+# Initialize components (the knowledge base loads in the background while the server starts)
 llm = GeminiLLM()
-rag = GraphRAG()
+rag = GraphRAG(
+    "src/knowledge_graph/schema.metta",
+    "src/knowledge_graph/data.metta",
+    prefetch=True
+)
 extractor = AutoExtractor()
 
-# Load knowledge base
-@app.on_event("startup")
-async def startup_event():
-    """Load knowledge base on startup."""
-    try:
-        rag.load_knowledge_base(
-            "src/knowledge_graph/schema.metta",
-            "src/knowledge_graph/data.metta"
-        )
-    except Exception as e:
-        print(f"Error loading knowledge base: {e}")
+# Answers to earlier questions, reused when the same question is asked again against the same context
+answer_cache = QuestionCache()
 
 # Serve demo.html at the root
+@lru_cache(maxsize=1)
+def load_demo_page() -> Tuple[bytes, str]:
+    """Read demo.html once and compute its ETag."""
+    content = Path("demo.html").read_bytes()
+    return content, f'"{hashlib.md5(content).hexdigest()}"'
+
+def demo_page_response(request: Request) -> Response:
+    """Serve the cached demo page, answering conditional requests with 304 Not Modified."""
+    content, etag = load_demo_page()
+    headers = {'ETag': etag, 'Cache-Control': 'public, max-age=60'}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content, media_type="text/html", headers=headers)
+
 @app.get("/")
-async def get_demo():
-    return FileResponse("demo.html")
+async def get_demo(request: Request):
+    return demo_page_response(request)
 
 @app.get("/demo.html")
-async def get_demo_html():
-    return FileResponse("demo.html")
+async def get_demo_html(request: Request):
+    return demo_page_response(request)
 
 # Pydantic models for request/response validation
 class Question(BaseModel):
@@ -70,7 +87,13 @@ class FAQEntry(BaseModel):
     question: str
     answer: str
     category: str
-    concepts: Optional[str] = None
+    concepts: Optional[List[str]] = None
+    
+    @field_validator('concepts', mode='before')
+    @classmethod
+    def split_concepts(cls, value: Any) -> Any:
+        """Accept concepts as a space-separated string as well as a list."""
+        return value.split() if isinstance(value, str) else value
 
 class PropertyValue(BaseModel):
     value: str
@@ -90,21 +113,109 @@ class Relationship(BaseModel):
 class DocumentExtraction(BaseModel):
     text: str
 
+# Validates the JSON-encoded history form field of multimodal requests
+HISTORY_ADAPTER = TypeAdapter(List[Dict[str, str]])
+
+# Uploads are read in chunks of this size
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+async def read_upload(file: UploadFile) -> memoryview:
+    """Read an uploaded file into a single buffer chunk by chunk, without an extra full-size copy."""
+    buffer = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        buffer += chunk
+    return memoryview(buffer)
+
+# Limits concurrent image extractions to stay within the Gemini API quota.
+# Created on first use so it belongs to the server's event loop (on Python 3.9
+# a semaphore binds to the loop current when it is created).
+MAX_CONCURRENT_EXTRACTIONS = 8
+extraction_semaphore: Optional[asyncio.Semaphore] = None
+
+def get_extraction_semaphore() -> asyncio.Semaphore:
+    """Return the image extraction semaphore, creating it on the running event loop."""
+    global extraction_semaphore
+    if extraction_semaphore is None:
+        extraction_semaphore = asyncio.Semaphore(MAX_CONCURRENT_EXTRACTIONS)
+    return extraction_semaphore
+
+async def process_upload(file: UploadFile) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    Read an uploaded media file and extract entities from it if it is an image.
+    
+    Returns:
+        The media file entry for the LLM (None for unsupported types) and
+        the extraction result (None if nothing was extracted)
+    """
+    content_type = file.content_type
+    file_data = await read_upload(file)
+    
+    if content_type.startswith('image/'):
+        # Shrink large images before they are sent to the model (in a worker thread, as decoding is CPU-bound)
+        file_data, content_type = await asyncio.to_thread(downscale_image, file_data, content_type)
+        
+        # Add to media files for LLM processing
+        media_file = {
+            'type': 'image',
+            'data': file_data,
+            'mime_type': content_type
+        }
+        
+        try:
+            # Extract entities from the image
+            async with get_extraction_semaphore():
+                image_entities = await extractor.extract_from_image(file_data, content_type)
+        except Exception as extraction_error:
+            print(f"Entity extraction error (non-blocking): {str(extraction_error)}")
+            # Continue processing even if extraction fails
+            image_entities = None
+        
+        return media_file, image_entities
+    
+    if content_type.startswith('video/'):
+        # For videos, we'd need to extract frames or thumbnails
+        # This is a simplified approach
+        return {
+            'type': 'video',
+            'data': file_data,
+            'mime_type': content_type
+        }, None
+    
+    return None, None
+
 @app.post("/chat", response_model=Answer)
 async def chat(question: Question):
     """
     Get an answer to a question using the knowledge graph and LLM.
     """
     try:
-        # Query knowledge graph for context
-        context = rag.query_context(question.text)
+        # Query knowledge graph for context (in a worker thread so other requests aren't blocked)
+        context = await asyncio.to_thread(rag.query_context, question.text)
         
-        # Generate response using LLM with context
-        response = await llm.generate_response(
-            question=question.text,
-            context=context,
-            history=question.history
-        )
+        # Return a cached answer if the same question was answered from the same context
+        # (conversations with history are not cached since the history shapes the answer)
+        cache_scope = None
+        if not question.history:
+            cache_scope = hashlib.sha256(
+                orjson.dumps(context, option=orjson.OPT_SORT_KEYS, default=str)
+            ).hexdigest()
+            cached = answer_cache.get(question.text, scope=cache_scope)
+            if cached is not None:
+                return Answer(text=cached, context=context)
+        
+        # Generate response using LLM with context (errors are answered with an apology, which is never cached)
+        try:
+            response = await llm.generate_response(
+                question=question.text,
+                context=context,
+                history=question.history,
+                raise_errors=True
+            )
+        except Exception as generation_error:
+            return Answer(text=error_response(generation_error), context=context)
+        
+        if cache_scope is not None:
+            answer_cache.set(question.text, response, scope=cache_scope)
         
         return Answer(text=response, context=context)
     except Exception as e:
@@ -112,6 +223,7 @@ async def chat(question: Question):
 
 @app.post("/chat/multimodal")
 async def chat_multimodal(
+    background_tasks: BackgroundTasks,
     text: str = Form(...),
     files: List[UploadFile] = File(None),
     history: str = Form(None)
@@ -122,85 +234,47 @@ async def chat_multimodal(
     """
     try:
         # Parse history if provided
-        history_list = json.loads(history) if history else []
+        history_list = HISTORY_ADAPTER.validate_json(history) if history else []
         
         # Process uploaded files
         media_files = []
         extracted_entities = []
         
-        # Check if files is not None and not empty before iterating
+        # Read the uploads and run image extractions concurrently (results keep upload order)
         if files:
-            for file in files:
-                if file is None:
-                    continue
-                    
-                content_type = file.content_type
-                file_data = await file.read()
-                
-                if content_type.startswith('image/'):
-                    # Add to media files for LLM processing
-                    media_files.append({
-                        'type': 'image',
-                        'data': file_data,
-                        'mime_type': content_type
-                    })
-                    
-                    # Extract entities from image in background
-                    # We'll use the file data we already read
-                    try:
-                        # Extract entities from the image
-                        image_entities = await extractor.extract_from_image(file_data, content_type)
-                        extracted_entities.extend(image_entities.get('entities', []))
-                        # image_entities = {'entities': []}  # Fake empty result
-# Skip background task
-                        # Add extracted entities to the knowledge graph asynchronously
-                        # This won't block the response
-                        background_tasks = BackgroundTasks()
-                        background_tasks.add_task(add_extracted_data_to_graph, image_entities)
-                    except Exception as extraction_error:
-                        print(f"Entity extraction error (non-blocking): {str(extraction_error)}")
-                        # Continue processing even if extraction fails
-                
-                elif content_type.startswith('video/'):
-                    # For videos, we'd need to extract frames or thumbnails
-                    # This is a simplified approach
-                    media_files.append({
-                        'type': 'video',
-                        'data': file_data,
-                        'mime_type': content_type
-                    })
+            uploads = await asyncio.gather(*[process_upload(file) for file in files if file is not None])
+            for media_file, image_entities in uploads:
+                if media_file is not None:
+                    media_files.append(media_file)
+                if image_entities is not None:
+                    extracted_entities.extend(image_entities.get('entities', []))
+                    # Add extracted entities to the knowledge graph after the response is sent
+                    background_tasks.add_task(add_extracted_data_to_graph, image_entities)
         
-        # Enhance the query with extracted entities if any
-        enhanced_query = text
-        if extracted_entities:
-            entity_names = [entity.get('name', '') for entity in extracted_entities if entity.get('name')]
-            if entity_names:
-                enhanced_query = f"{text} (Considering these entities: {', '.join(entity_names)})"
-        
-        # Query knowledge graph for context
-        context = rag.query_context(enhanced_query)
+        # Query knowledge graph for context, also looking up the entities extracted from images
+        entity_names = [entity['name'] for entity in extracted_entities if entity.get('name')]
+        context = await asyncio.to_thread(rag.query_context, text, extra_concepts=entity_names)
         
         # Add extracted entities to context if they're not already included
+        ctx_names = {ctx['entity'].get('name') for ctx in context if 'entity' in ctx}
+        new_context = []
         for entity in extracted_entities:
-            entity_in_context = False
-            for ctx in context:
-                if 'entity' in ctx and ctx['entity'].get('name') == entity.get('name'):
-                    entity_in_context = True
-                    break
-            
-            if not entity_in_context and entity.get('name'):
+            name = entity.get('name')
+            if name and name not in ctx_names:
+                ctx_names.add(name)
                 # Convert to the format expected by the context
                 formatted_entity = {
-                    'name': entity.get('name', ''),
+                    'name': name,
                     'type': entity.get('entity_type', 'Unknown'),
                     'properties': entity.get('properties', {}),
                     'relations': entity.get('relations', [])
                 }
-                context.append({'entity': formatted_entity, 'score': 0.9, 'source': 'image_extraction'})
+                new_context.append({'entity': formatted_entity, 'score': 0.9, 'source': 'image_extraction'})
+        context.extend(new_context)
         
         # Generate response using LLM with context and media
         response = await llm.generate_response(
-            question=enhanced_query,
+            question=text,
             context=context,
             history=history_list,
             media_files=media_files
@@ -212,7 +286,7 @@ async def chat_multimodal(
             "assistant": response
         })
         
-        return JSONResponse(content={
+        return ORJSONResponse(content={
             "text": response, 
             "context": context,
             "history": history_list,
@@ -226,8 +300,7 @@ async def chat_multimodal(
 async def add_faq(faq: FAQEntry):
     """Add a new FAQ entry to the knowledge graph."""
     try:
-        concepts_list = faq.concepts.split() if faq.concepts else None
-        rag.add_faq(faq.question, faq.answer, faq.category, concepts_list)
+        await asyncio.to_thread(rag.add_faq, faq.question, faq.answer, faq.category, faq.concepts)
         return {"message": "FAQ added successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -241,7 +314,7 @@ async def add_entity(entity: Entity):
             for key, prop in entity.properties.items()
         } if entity.properties else None
         
-        rag.add_entity(entity.name, entity.entity_type, properties_dict)
+        await asyncio.to_thread(rag.add_entity, entity.name, entity.entity_type, properties_dict)
         return {"message": "Entity added successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -250,7 +323,8 @@ async def add_entity(entity: Entity):
 async def add_relationship(relationship: Relationship):
     """Add a new relationship between entities."""
     try:
-        rag.add_relationship(
+        await asyncio.to_thread(
+            rag.add_relationship,
             relationship.from_entity,
             relationship.relationship_type,
             relationship.to_entity,
@@ -306,7 +380,7 @@ async def extract_from_image(file: UploadFile = File(...), background_tasks: Bac
     """
     try:
         # Read image data
-        image_data = await file.read()
+        image_data = await read_upload(file)
         content_type = file.content_type
         
         # Extract knowledge from image
@@ -323,48 +397,29 @@ async def extract_from_image(file: UploadFile = File(...), background_tasks: Bac
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-async def add_extracted_data_to_graph(data: Dict[str, Any]):
+def add_extracted_data_to_graph(data: Dict[str, Any]):
     """
     Add extracted data to the knowledge graph.
+    Declared sync so background tasks run it in the threadpool instead of on the event loop.
     
     Args:
         data: Dictionary containing entities, relationships, and FAQ entries
     """
-    # Add entities
-    for entity in data.get('entities', []):
-        try:
-            rag.add_entity(
-                name=entity['name'],
-                entity_type=entity['type'],
-                properties=entity.get('properties', {})
-            )
-        except Exception as e:
-            print(f"Error adding entity {entity['name']}: {e}")
+    # Add each kind of item in a single knowledge graph update
+    try:
+        rag.add_entities_bulk(data.get('entities', []))
+    except Exception as e:
+        print(f"Error adding entities: {e}")
     
-    # Add relationships
-    for rel in data.get('relationships', []):
-        try:
-            rag.add_relationship(
-                from_entity=rel['from_entity'],
-                relationship_type=rel['relationship_type'],
-                to_entity=rel['to_entity'],
-                context=rel.get('context', '')
-            )
-        except Exception as e:
-            print(f"Error adding relationship: {e}")
+    try:
+        rag.add_relationships_bulk(data.get('relationships', []))
+    except Exception as e:
+        print(f"Error adding relationships: {e}")
     
-    # Add FAQ entries
-    for faq in data.get('faq_entries', []):
-        try:
-            concepts = faq.get('concepts', '').split() if 'concepts' in faq else None
-            rag.add_faq(
-                question=faq['question'],
-                answer=faq['answer'],
-                category=faq.get('category', 'General'),
-                concepts=concepts
-            )
-        except Exception as e:
-            print(f"Error adding FAQ: {e}")
+    try:
+        rag.add_faqs_bulk(data.get('faq_entries', []))
+    except Exception as e:
+        print(f"Error adding FAQs: {e}")
 
 if __name__ == "__main__":
     import uvicorn
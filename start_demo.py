@@ -5,9 +5,17 @@ import subprocess
 import time
 import signal
 import platform
-import requests
+import socket
 from pathlib import Path
 
+def server_is_up():
+    """Check whether the server is accepting connections on port 8000"""
+    try:
+        socket.create_connection(("127.0.0.1", 8000), timeout=0.2).close()
+        return True
+    except OSError:
+        return False
+
 def start_server():
     """Start the FastAPI server"""
     print("Starting the server...")
@@ -26,20 +34,16 @@ def start_server():
     # Wait for the server to start
     print("Waiting for server to start...")
     
-    # Wait for the server to be ready
-    max_attempts = 10
+    # Wait for the server to be ready (probe every 0.1 s for up to 30 s)
+    max_attempts = 300
     attempts = 0
     while attempts < max_attempts:
-        try:
-            response = requests.get("http://localhost:8000/docs")
-            if response.status_code == 200:
-                print("Server is ready!")
-                break
-        except requests.exceptions.ConnectionError:
-            pass
+        if server_is_up():
+            print("Server is ready!")
+            break
         
         attempts += 1
-        time.sleep(2)
+        time.sleep(0.1)
     
     if attempts == max_attempts:
         print("Warning: Could not confirm server is running. Proceeding anyway...")
@@ -60,14 +64,10 @@ def main():
     print("----------------------------------------")
     
     # Check if the server is already running
-    try:
-        response = requests.get("http://localhost:8000/docs")
-        if response.status_code == 200:
-            print("Server is already running.")
-            server_process = None
-        else:
-            server_process = start_server()
-    except requests.exceptions.ConnectionError:
+    if server_is_up():
+        print("Server is already running.")
+        server_process = None
+    else:
         server_process = start_server()
     
     # Open the demo interface